@@ -1,9 +1,45 @@
 from passlib.context import CryptContext
+from concurrent.futures import ThreadPoolExecutor
+from os import environ
+import asyncio
 
-context = CryptContext(schemes=["bcrypt"])
+BCRYPT_ROUNDS = int(environ.get("BCRYPT_ROUNDS", 12))
+HASH_WORKERS = int(environ.get("HASH_WORKERS", 2))
+HASH_QUEUE = int(environ.get("HASH_QUEUE", 32))
+
+context = CryptContext(schemes=["bcrypt"], bcrypt__rounds=BCRYPT_ROUNDS)
+executor = ThreadPoolExecutor(HASH_WORKERS, thread_name_prefix="bcrypt")
+metrics = {"running": 0, "completed": 0, "rejected": 0}
+
+class Saturated(Exception):
+    """The hashing pool already has HASH_QUEUE requests waiting"""
 
 def hash(password: str) -> str:
     return context.hash(password)
 
 def verify(password: str, hash: str) -> bool:
-    return context.verify(password, hash)
\ No newline at end of file
+    return context.verify(password, hash)
+
+async def run(function, *args):
+    if metrics["running"] >= HASH_WORKERS + HASH_QUEUE:
+        metrics["rejected"] += 1
+        raise Saturated()
+    metrics["running"] += 1
+    try:
+        return await asyncio.get_running_loop().run_in_executor(executor, function, *args)
+    finally:
+        metrics["running"] -= 1
+        metrics["completed"] += 1
+
+async def hash_async(password: str) -> str:
+    return await run(hash, password)
+
+async def verify_async(password: str, hash: str) -> bool:
+    return await run(verify, password, hash)
+
+async def verify_and_update(password: str, hash: str) -> tuple[bool, str | None]:
+    """Verifies the password and returns a new hash when the stored one uses an outdated cost"""
+    return await run(context.verify_and_update, password, hash)
+
+def stats() -> dict:
+    return {"workers": HASH_WORKERS, "queued": max(0, metrics["running"] - HASH_WORKERS), **metrics}
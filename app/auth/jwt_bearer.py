@@ -1,56 +1,94 @@
-from fastapi import Request, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi import Request, HTTPException, WebSocket
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from collections import OrderedDict
+from dataclasses import dataclass
+from os import environ
+import hashlib, time
 
 from app.auth.jwt_handler import access_decode, refresh_decode
 
+TOKEN_CACHE_SIZE = int(environ.get("TOKEN_CACHE_SIZE", 4096))
+
+
+@dataclass(frozen=True)
+class Principal:
+    id: int
+    exp: float
+
+
+class TokenCache:
+    """Bounded LRU of verified tokens keyed by token hash, entries are dropped once the token expires"""
+    def __init__(self, size: int):
+        self.size = size
+        self.entries = OrderedDict()
+
+    def get(self, token: str) -> Principal:
+        key = hashlib.sha256(token.encode()).digest()
+        principal = self.entries.get(key)
+        if principal is None:
+            return None
+        if principal.exp <= time.time():
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return principal
+
+    def put(self, token: str, principal: Principal):
+        self.entries[hashlib.sha256(token.encode()).digest()] = principal
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+
+access_cache = TokenCache(TOKEN_CACHE_SIZE)
+refresh_cache = TokenCache(TOKEN_CACHE_SIZE)
+
+
+def verify(token: str, decode, cache: TokenCache) -> Principal:
+    principal = cache.get(token)
+    if principal is None:
+        payload = decode(token)
+        if not payload:
+            return None
+        principal = Principal(id=payload["id"], exp=payload["exp"])
+        cache.put(token, principal)
+    return principal
+
 
 class JWTAccessBearer(HTTPBearer):
     def __init__(self, auto_error: bool = True):
         super(JWTAccessBearer, self).__init__(auto_error=auto_error)
 
-    async def __call__(self, request: Request):
+    async def __call__(self, request: Request) -> Principal:
         credentials: HTTPAuthorizationCredentials = await super(JWTAccessBearer, self).__call__(request)
         if credentials:
             if not credentials.scheme == "Bearer":
                 raise HTTPException(status_code=403, detail="Invalid authentication scheme.")
-            if not self.verify_jwt(credentials.credentials):
+            principal = verify(credentials.credentials, access_decode, access_cache)
+            if not principal:
                 raise HTTPException(status_code=403, detail="Invalid token or expired token.")
-            return credentials.credentials
+            return principal
         else:
             raise HTTPException(status_code=403, detail="Invalid authorization code.")
 
-    def verify_jwt(self, jwtoken: str) -> bool:
-        isTokenValid: bool = False
-        try:
-            payload = access_decode(jwtoken)
-        except:
-            payload = None
-        if payload:
-            isTokenValid = True
-        return isTokenValid
-
 class JWTRefreshBearer(HTTPBearer):
     def __init__(self, auto_error: bool = True):
         super(JWTRefreshBearer, self).__init__(auto_error=auto_error)
 
-    async def __call__(self, request: Request):
+    async def __call__(self, request: Request) -> Principal:
         credentials: HTTPAuthorizationCredentials = await super(JWTRefreshBearer, self).__call__(request)
         if credentials:
             if not credentials.scheme == "Bearer":
                 raise HTTPException(status_code=403, detail="Invalid authentication scheme.")
-            if not self.verify_jwt(credentials.credentials):
+            principal = verify(credentials.credentials, refresh_decode, refresh_cache)
+            if not principal:
                 raise HTTPException(status_code=403, detail="Invalid token or expired token.")
-            return credentials.credentials
+            return principal
         else:
             raise HTTPException(status_code=403, detail="Invalid authorization code.")
 
-    def verify_jwt(self, jwtoken: str) -> bool:
-        isTokenValid: bool = False
-        try:
-            payload = refresh_decode(jwtoken)
-        except:
-            payload = None
-        if payload:
-            isTokenValid = True
-        return isTokenValid
\ No newline at end of file
+def websocket_principal(websocket: WebSocket) -> Principal:
+    """Principal of a WebSocket handshake, the token comes from the Authorization header or the token query parameter"""
+    scheme, _, token = websocket.headers.get("Authorization", "").partition(" ")
+    if scheme != "Bearer":
+        token = websocket.query_params.get("token")
+    return verify(token, access_decode, access_cache) if token else None
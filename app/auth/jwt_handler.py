@@ -1,6 +1,6 @@
 import jwt
 from os import environ
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 
 ACCESS_SECRET = environ["JWT_ACCESS_SECRET"]
 REFRESH_SECRET = environ["JWT_REFRESH_SECRET"]
@@ -9,23 +9,28 @@ ACCESS_EXPIRE = timedelta(minutes=30)
 REFRESH_EXPIRE = timedelta(days=7)
 
 def access_token(id: int) -> str:
-    payload = {"expire": (datetime.today() + ACCESS_EXPIRE).ctime(), "id": id}
+    payload = {"exp": datetime.now(timezone.utc) + ACCESS_EXPIRE, "id": id}
     return jwt.encode(payload, ACCESS_SECRET, ALGORITHM)
 
 def refresh_token(id: int) -> str:
-    payload = {"expire": (datetime.today() + REFRESH_EXPIRE).ctime(), "id": id}
+    payload = {"exp": datetime.now(timezone.utc) + REFRESH_EXPIRE, "id": id}
     return jwt.encode(payload, REFRESH_SECRET, ALGORITHM)
 
-def access_decode(token: str) -> dict:
+def decode(token: str, secret: str) -> dict:
+    """Verified payload with a numeric exp, None for invalid or expired tokens"""
     try:
-        decoded_token = jwt.decode(token, ACCESS_SECRET, algorithms=[ALGORITHM])
-        return decoded_token if decoded_token["expire"] >= datetime.today().ctime() else None
+        decoded_token = jwt.decode(token, secret, algorithms=[ALGORITHM])
+        if "exp" not in decoded_token:
+            # Tokens issued before exp was introduced carry a ctime() string in local time
+            decoded_token["exp"] = datetime.strptime(decoded_token["expire"], "%a %b %d %H:%M:%S %Y").timestamp()
+            if decoded_token["exp"] < datetime.now().timestamp():
+                return None
+        return decoded_token
     except:
         return None
+
+def access_decode(token: str) -> dict:
+    return decode(token, ACCESS_SECRET)
     
 def refresh_decode(token: str) -> dict:
-    try:
-        decoded_token = jwt.decode(token, REFRESH_SECRET, algorithms=[ALGORITHM])
-        return decoded_token if decoded_token["expire"] >= datetime.today().ctime() else None
-    except:
-        return None
\ No newline at end of file
+    return decode(token, REFRESH_SECRET)
@@ -1,15 +1,149 @@
-from fastapi_mail import ConnectionConfig
+"""
+Outgoing email. Templates are compiled once by preload at startup and kept by the environment, with
+MAIL_TEMPLATES_RELOAD (on under DEBUG) a template is recompiled when its file changes. send renders the message,
+queues it and returns, MAIL_CONNECTIONS workers each keep one SMTP connection open between messages, drain the
+queue in batches of up to MAIL_BATCH over it and retry transient failures with backoff on a fresh connection
+"""
+from email.message import EmailMessage
+from email.utils import formataddr
 from os import environ
+import aiosmtplib, asyncio, jinja2, logging, random
 
-configuration = ConnectionConfig(
-    MAIL_USERNAME=environ["MAIL_USERNAME"],
-    MAIL_PASSWORD=environ["MAIL_PASSWORD"],
-    MAIL_FROM=environ["MAIL_FROM"],
-    MAIL_PORT=587,
-    MAIL_SERVER=environ["MAIL_SERVER"],
-    MAIL_FROM_NAME="Quore",
-    MAIL_STARTTLS=True,
-    MAIL_SSL_TLS=False,
-    USE_CREDENTIALS=True,
-    VALIDATE_CERTS=True
-)
\ No newline at end of file
+MAIL_USERNAME = environ["MAIL_USERNAME"]
+MAIL_PASSWORD = environ["MAIL_PASSWORD"]
+MAIL_FROM = formataddr(("Quore", environ["MAIL_FROM"]))
+MAIL_SERVER = environ["MAIL_SERVER"]
+MAIL_PORT = int(environ.get("MAIL_PORT", 587))
+MAIL_STARTTLS = int(environ.get("MAIL_STARTTLS", 1))
+MAIL_CONNECTIONS = int(environ.get("MAIL_CONNECTIONS", 2))
+MAIL_BATCH = int(environ.get("MAIL_BATCH", 50))
+# Servers drop idle sessions after a few minutes, an idle worker closes its connection first
+MAIL_IDLE = float(environ.get("MAIL_IDLE", 60))
+MAIL_RETRIES = int(environ.get("MAIL_RETRIES", 4))
+MAIL_TEMPLATES_RELOAD = int(environ.get("MAIL_TEMPLATES_RELOAD", environ.get("DEBUG", 0)))
+BACKOFF = 1
+TEMPLATES = ("confirm.html", "gdpr.html", "gdpr_ready.html")
+
+logger = logging.getLogger(__name__)
+# Names, messages and statuses are user input, none of the templates takes raw HTML
+templates = jinja2.Environment(loader=jinja2.FileSystemLoader("."), auto_reload=bool(MAIL_TEMPLATES_RELOAD),
+                               autoescape=jinja2.select_autoescape(["html"]))
+
+def preload():
+    for name in TEMPLATES:
+        templates.get_template(name)
+
+def render(template: str, **context) -> str:
+    return templates.get_template(template).render(**context)
+
+class SmtpTransport:
+    async def connect(self) -> aiosmtplib.SMTP:
+        connection = aiosmtplib.SMTP(hostname=MAIL_SERVER, port=MAIL_PORT, username=MAIL_USERNAME, password=MAIL_PASSWORD,
+                                     start_tls=bool(MAIL_STARTTLS))
+        await connection.connect()
+        return connection
+
+    async def send(self, connection: aiosmtplib.SMTP, message: EmailMessage):
+        await connection.send_message(message)
+
+    async def close(self, connection: aiosmtplib.SMTP):
+        try:
+            await connection.quit()
+        except (aiosmtplib.SMTPException, OSError):
+            connection.close()
+
+class FakeTransport:
+    """Local stand-in for the SMTP server, records sent messages and counts opened connections"""
+    def __init__(self):
+        self.sent = []
+        self.connections = 0
+
+    async def connect(self):
+        self.connections += 1
+        return self.connections
+
+    async def send(self, connection, message: EmailMessage):
+        self.sent.append(message)
+
+    async def close(self, connection):
+        pass
+
+class Mailer:
+    def __init__(self, transport):
+        self.transport = transport
+        self.queue = asyncio.Queue()
+        self.tasks = []
+
+    def start(self):
+        self.tasks = [asyncio.create_task(self.run()) for _ in range(MAIL_CONNECTIONS)]
+
+    async def stop(self, timeout: float = 5):
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Dropping %d queued emails on shutdown", self.queue.qsize())
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+    def enqueue(self, message: EmailMessage, attempt: int = 0):
+        self.queue.put_nowait((message, attempt))
+
+    async def run(self):
+        connection = None
+        try:
+            while True:
+                try:
+                    batch = [await asyncio.wait_for(self.queue.get(), MAIL_IDLE if connection else None)]
+                except asyncio.TimeoutError:
+                    await self.transport.close(connection)
+                    connection = None
+                    continue
+                while len(batch) < MAIL_BATCH and not self.queue.empty():
+                    batch.append(self.queue.get_nowait())
+                try:
+                    connection = await self.deliver(connection, batch)
+                finally:
+                    for _ in batch:
+                        self.queue.task_done()
+        finally:
+            if connection:
+                await self.transport.close(connection)
+
+    async def deliver(self, connection, batch: list):
+        """Sends the batch over the connection, returns the connection to keep for the next batch"""
+        for message, attempt in batch:
+            try:
+                if not connection:
+                    connection = await self.transport.connect()
+                await self.transport.send(connection, message)
+            except aiosmtplib.SMTPRecipientsRefused:
+                logger.warning("Recipient %s refused", message["To"])
+            except Exception:
+                logger.exception("Sending an email failed")
+                if connection:
+                    await self.transport.close(connection)
+                connection = None
+                self.retry(message, attempt + 1)
+        return connection
+
+    def retry(self, message: EmailMessage, attempt: int):
+        if attempt > MAIL_RETRIES:
+            logger.warning("Giving up on an email to %s after %d attempts", message["To"], attempt)
+            return
+        delay = BACKOFF * 2 ** (attempt - 1) * (1 + random.random())
+        asyncio.get_running_loop().call_later(delay, self.enqueue, message, attempt)
+
+if environ.get("MAIL_TRANSPORT", "smtp") == "fake":
+    mailer = Mailer(FakeTransport())
+else:
+    mailer = Mailer(SmtpTransport())
+
+def send(subject: str, recipient: str, template: str, **context):
+    """Renders the template into an HTML email and queues it"""
+    message = EmailMessage()
+    message["From"] = MAIL_FROM
+    message["To"] = recipient
+    message["Subject"] = subject
+    message.set_content(render(template, **context), subtype="html")
+    mailer.enqueue(message)
@@ -0,0 +1,21 @@
+"""
+Awaitable versions of every crud function that takes a session as its first argument.
+With an AsyncSession the function runs through run_sync on the asyncpg connection,
+with a regular Session it is moved to the threadpool, so the event loop never waits on the database.
+"""
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.concurrency import run_in_threadpool
+from app.data import crud
+import functools, inspect
+
+def awaitable(function):
+    @functools.wraps(function)
+    async def wrapper(db, *args, **kwargs):
+        if isinstance(db, AsyncSession):
+            return await db.run_sync(function, *args, **kwargs)
+        return await run_in_threadpool(function, db, *args, **kwargs)
+    return wrapper
+
+for name, function in inspect.getmembers(crud, inspect.isfunction):
+    if function.__module__ == crud.__name__ and not name.startswith('_') and next(iter(inspect.signature(function).parameters), None) == 'db':
+        globals()[name] = awaitable(function)
@@ -0,0 +1,128 @@
+"""
+Read-through cache of profile rows keyed by profile id, used by crud.get_profile, get_profile_name and get_fcm_token.
+crud invalidates an entry whenever it writes one of the cached columns. With several workers the memory backend
+only sees invalidations made by its own worker, entries elsewhere live until PROFILE_CACHE_TTL, a deleted profile
+included. Writes that need the profile to exist check the database through crud.profile_exists instead. The sqlite
+backend is shared by all workers of a host and sees every invalidation. PROFILE_CACHE=none turns caching off
+"""
+from collections import OrderedDict
+from os import environ
+from sqlalchemy.exc import MissingGreenlet
+from sqlalchemy.util import await_only
+from app.data.database import DB_ASYNC
+import asyncio, json, sqlite3, threading, time
+
+PROFILE_CACHE = environ.get("PROFILE_CACHE", "memory")
+PROFILE_CACHE_SIZE = int(environ.get("PROFILE_CACHE_SIZE", 50000))
+PROFILE_CACHE_TTL = float(environ.get("PROFILE_CACHE_TTL", 300))
+PROFILE_CACHE_PATH = environ.get("PROFILE_CACHE_PATH", "/tmp/quore-profiles.sqlite")
+
+class MemoryBackend:
+    """LRU of at most size entries, each expiring ttl seconds after it was stored"""
+    def __init__(self, size: int, ttl: float):
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key: int) -> dict | None:
+        with self.lock:
+            entry = self.entries.get(key)
+            if not entry:
+                return None
+            if entry[1] <= time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return entry[0]
+
+    def set(self, key: int, value: dict):
+        with self.lock:
+            self.entries[key] = (value, time.monotonic() + self.ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def delete(self, key: int):
+        with self.lock:
+            self.entries.pop(key, None)
+
+class SqliteBackend:
+    """Stand-in for a shared cache server, one sqlite file in WAL mode shared by the workers of a host"""
+    def __init__(self, path: str, ttl: float):
+        self.path = path
+        self.ttl = ttl
+        self.local = threading.local()
+        with self.connection() as connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS profiles (id INTEGER PRIMARY KEY, value TEXT NOT NULL, expires REAL NOT NULL)")
+
+    def connection(self) -> sqlite3.Connection:
+        if not hasattr(self.local, "connection"):
+            self.local.connection = sqlite3.connect(self.path, timeout=1, isolation_level=None)
+            self.local.connection.execute("PRAGMA journal_mode=WAL")
+        return self.local.connection
+
+    def execute(self, statement: str, parameters: tuple):
+        return self.connection().execute(statement, parameters).fetchone()
+
+    def offload(self, statement: str, parameters: tuple):
+        """With DB_ASYNC crud runs inside AsyncSession.run_sync on the event loop, the file is then read in a thread"""
+        if DB_ASYNC:
+            try:
+                return await_only(asyncio.to_thread(self.execute, statement, parameters))
+            except MissingGreenlet:
+                pass
+        return self.execute(statement, parameters)
+
+    def get(self, key: int) -> dict | None:
+        row = self.offload("SELECT value FROM profiles WHERE id = ? AND expires > ?", (key, time.time()))
+        return json.loads(row[0]) if row else None
+
+    def set(self, key: int, value: dict):
+        self.offload("INSERT OR REPLACE INTO profiles VALUES (?, ?, ?)", (key, json.dumps(value), time.time() + self.ttl))
+
+    def delete(self, key: int):
+        self.offload("DELETE FROM profiles WHERE id = ?", (key,))
+
+class NullBackend:
+    def get(self, key: int) -> dict | None:
+        return None
+
+    def set(self, key: int, value: dict):
+        pass
+
+    def delete(self, key: int):
+        pass
+
+class Cache:
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: int, load) -> dict | None:
+        """Cached value of the key, on a miss load(key) is called and its result stored unless it is None"""
+        value = self.backend.get(key)
+        if value is not None:
+            self.hits += 1
+            return value
+        self.misses += 1
+        value = load(key)
+        if value is not None:
+            self.backend.set(key, value)
+        return value
+
+    def invalidate(self, *keys: int):
+        for key in keys:
+            self.backend.delete(key)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {"backend": PROFILE_CACHE, "hits": self.hits, "misses": self.misses, "hit_rate": round(self.hits / total, 4) if total else None}
+
+backends = {
+    "memory": lambda: MemoryBackend(PROFILE_CACHE_SIZE, PROFILE_CACHE_TTL),
+    "sqlite": lambda: SqliteBackend(PROFILE_CACHE_PATH, PROFILE_CACHE_TTL),
+    "none": NullBackend,
+}
+profiles = Cache(backends[PROFILE_CACHE]())
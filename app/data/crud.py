@@ -1,38 +1,73 @@
 from app.data import media
-from sqlalchemy.orm import Session, load_only
+from sqlalchemy.orm import Session, load_only, aliased
 from sqlalchemy.orm.attributes import flag_modified
 from typing import List
 from random import sample
-from datetime import datetime
-from app.data import models, schemas
-from app.auth.hash import hash
-import geopy.distance
+from datetime import datetime, timedelta
+from app.data import models, schemas, recommend, geo, cache
+from sqlalchemy import func, case, exists, literal, tuple_, or_, and_, select, update, delete, text, cast, Float
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.dialects.postgresql import insert, JSONB
+import math, json, base64, binascii, secrets, uuid
+
+EARTH_RADIUS = geo.EARTH_RADIUS
+# Rows fetched per round trip by the stream_* server side cursors
+STREAM_BATCH = 1000
+# A 128-bit token collides with an existing one practically never, the retry is only there to make it certain
+TOKEN_ATTEMPTS = 3
 
 def get_user_by_email(db: Session, email: str):
     return db.query(models.Auth).filter(models.Auth.email == email).first()
 
-def get_hashed(db: Session, email: str):
-    return db.query(models.Auth).filter(models.Auth.email == email).first().hashed
+def get_login(db: Session, email: str):
+    """Everything /login and /resend need from Auth in one query: user_id, hashed, verified, sent"""
+    return db.query(models.Auth.user_id, models.Auth.hashed, models.Auth.verified, models.Auth.sent).filter(models.Auth.email == email).first()
 
 def get_auth_profile(db: Session, id: int):
     return db.query(models.Auth).filter(models.Auth.user_id == id).first()
 
-def get_id(db: Session, email: str):
-    return db.query(models.Auth).filter(models.Auth.email == email).first().user_id
+PROFILE_COLUMNS = (models.Profile.id, models.Profile.name, models.Profile.status, models.Profile.about, models.Profile.age,
+                   models.Profile.avatar, models.Profile.avatar_version, models.Profile.preferences, models.Profile.fcm_token)
+
+def cached_profile(db: Session, id: int) -> dict | None:
+    """PROFILE_COLUMNS of the profile through cache.profiles, None when it does not exist"""
+    def load(id: int):
+        row = db.query(*PROFILE_COLUMNS).filter(models.Profile.id == id).first()
+        if not row:
+            return None
+        # age is a Decimal from extract(), the shared backend stores JSON
+        return {**row._asdict(), "age": int(row.age) if row.age is not None else None}
+    return cache.profiles.get(id, load)
 
 def get_profile(db: Session, id: int):
-    profile = db.query(models.Profile).options(load_only(models.Profile.name, models.Profile.status, models.Profile.about, models.Profile.age, models.Profile.avatar, models.Profile.preferences)).get(id).__dict__
-    if profile['avatar']:
-        profile['avatar'] = media.get_avatar(id)
+    cached = cached_profile(db, id)
+    if not cached:
+        return None
+    profile = {key: cached[key] for key in ("id", "name", "status", "about", "age", "preferences")}
+    if cached['avatar']:
+        # Entries cached before avatar_version existed have none
+        profile['avatar'] = media.get_avatar(id, version=cached.get('avatar_version', 0))
     else:
         profile['avatar'] = None
     return profile
 
+def profile_exists(db: Session, id: int) -> bool:
+    """Checked in the database, the cache can still hold a profile deleted by another worker"""
+    return db.query(exists().where(models.Profile.id == id)).scalar()
+
 def get_profile_name(db: Session, id: int):
-    return db.query(models.Profile).filter(models.Profile.id == id).first().name
+    cached = cached_profile(db, id)
+    return cached['name'] if cached else None
 
 def get_fcm_token(db: Session, id: int):
-    return db.query(models.Profile).filter(models.Profile.id == id).first().fcm_token
+    cached = cached_profile(db, id)
+    return cached['fcm_token'] if cached else None
+
+def clear_fcm_tokens(db: Session, tokens: list[str]):
+    ids = [id for id, in db.query(models.Profile.id).filter(models.Profile.fcm_token.in_(tokens))]
+    db.query(models.Profile).filter(models.Profile.fcm_token.in_(tokens)).update({models.Profile.fcm_token: ''}, synchronize_session=False)
+    db.commit()
+    cache.profiles.invalidate(*ids)
 
 def write_message(db: Session, sender: int, recipient: int, text: str = None):
     message = models.Messages(sender=sender, recipient=recipient, message=text)
@@ -49,8 +84,21 @@ def add_files_to_message(db: Session, id: int, filenames: list[str]):
     db.flush()
     db.commit()
 
-def get_messages(db: Session, sender: int, recipient: int):
-    messages = db.query(models.Messages).filter(models.Messages.sender == sender, models.Messages.recipient == recipient).all() + db.query(models.Messages).filter(models.Messages.sender == recipient, models.Messages.recipient == sender).all()
+def get_messages(db: Session, sender: int, recipient: int, before: int = None, after: int = None, limit: int = 50):
+    """
+    Page of a conversation in chronological order, served by ix_messages_conversation.
+    Without cursors returns the latest messages, before/after are message ids bounding the page
+    """
+    query = db.query(models.Messages).filter(func.least(models.Messages.sender, models.Messages.recipient) == min(sender, recipient),
+                                             func.greatest(models.Messages.sender, models.Messages.recipient) == max(sender, recipient))
+    if before is not None:
+        query = query.filter(models.Messages.id < before)
+    if after is not None:
+        query = query.filter(models.Messages.id > after)
+    if after is not None and before is None:
+        messages = query.order_by(models.Messages.id).limit(limit).all()
+    else:
+        messages = query.order_by(models.Messages.id.desc()).limit(limit).all()[::-1]
     result = []
     for message in messages:
         message_dict = message.__dict__
@@ -61,40 +109,40 @@ def get_messages(db: Session, sender: int, recipient: int):
         result.append(message_dict)
     return result
 
-def get_all_messages(db: Session, id: int):
-    messages = db.query(models.Messages).filter(models.Messages.sender == id).all() + db.query(models.Messages).filter(models.Messages.recipient == id).all()
-    result = []
-    added = []
-    for message in messages:
-        if message.recipient != id and message.recipient not in added:
-            result.append([message.recipient, db.query(models.Messages).filter(models.Messages.recipient == message.recipient, models.Messages.sender == id).all() + db.query(models.Messages).filter(models.Messages.recipient == id, models.Messages.sender == message.recipient).all()])
-            added.append(message.recipient)
-        elif message.sender != id and message.sender not in added:
-            result.append([message.sender, db.query(models.Messages).filter(models.Messages.recipient == message.sender, models.Messages.sender == id).all() + db.query(models.Messages).filter(models.Messages.recipient == id, models.Messages.sender == message.sender).all()])
-            added.append(message.sender)
-    for i in range(len(result)):
-        result[i][0] = db.query(models.Profile).get(result[i][0]).name
-        for j in range(len(result[i][1])):
-            result[i][1][j] = result[i][1][j].__dict__
-            result[i][1][j]["sender"] = db.query(models.Profile).get(result[i][1][j]["sender"]).name
-            result[i][1][j]["recipient"] = db.query(models.Profile).get(result[i][1][j]["recipient"]).name
-            if result[i][1][j]["attachments"] == []:
-                result[i][1][j]["attachments"] = None
-            else:
-                result[i][1][j]["attachments"] = ' '.join(result[i][1][j]["attachments"])
-    return result
+def stream_messages(db: Session, id: int):
+    """
+    Messages of all conversations of the user grouped by partner, read through a server side cursor STREAM_BATCH rows at a time.
+    Rows carry partner, partner_name and names instead of ids for sender and recipient
+    """
+    sender = aliased(models.Profile)
+    recipient = aliased(models.Profile)
+    partner = case((models.Messages.sender == id, models.Messages.recipient), else_=models.Messages.sender)
+    return db.execute(select(models.Messages.id, models.Messages.sent, models.Messages.message, models.Messages.attachments, partner.label('partner'),
+                             case((models.Messages.sender == id, recipient.name), else_=sender.name).label('partner_name'),
+                             sender.name.label('sender'), recipient.name.label('recipient')).
+                      join(sender, sender.id == models.Messages.sender).join(recipient, recipient.id == models.Messages.recipient).
+                      where(or_(models.Messages.sender == id, models.Messages.recipient == id)).
+                      order_by(partner, models.Messages.sent, models.Messages.id).execution_options(yield_per=STREAM_BATCH))
+
+def stream_attachments(db: Session, id: int):
+    """Keys of the attachments in all conversations of the user, streamed like stream_messages"""
+    return db.execute(select(func.unnest(models.Messages.attachments)).where(or_(models.Messages.sender == id, models.Messages.recipient == id)).
+                      execution_options(yield_per=STREAM_BATCH)).scalars()
+
 def get_images(db: Session, id: int):
     return db.query(models.Profile).filter(models.Profile.id == id).first().images
 
-def add_image(db: Session, id: int):
-    profile = db.query(models.Profile).get(id)
-    profile.images.append(str(id) + '_' + str(profile.uploaded) + '.png')
-    profile.uploaded += 1
-    flag_modified(profile, 'images')
-    db.merge(profile)
-    db.flush()
+def reserve_image(db: Session, id: int) -> int:
+    """Number of the next gallery image of the user, add_image lists it once it is uploaded"""
+    uploaded = db.execute(update(models.Profile).where(models.Profile.id == id).
+                          values(uploaded=func.coalesce(models.Profile.uploaded, 0) + 1).returning(models.Profile.uploaded)).scalar()
+    db.commit()
+    return uploaded - 1
+
+def add_image(db: Session, id: int, count: int):
+    db.execute(update(models.Profile).where(models.Profile.id == id).
+               values(images=func.array_append(models.Profile.images, str(id) + '_' + str(count) + '.png')))
     db.commit()
-    return profile.uploaded - 1
 
 def delete_image(db: Session, id: int, file: str):
     profile = db.query(models.Profile).get(id)
@@ -105,9 +153,12 @@ def delete_image(db: Session, id: int, file: str):
     db.commit()
 
 def create_avatar(db: Session, id: int):
-    profile = db.query(models.Profile).get(id)
-    profile.avatar = True
+    """Called once the new avatar is uploaded, the version bump makes every worker sign a fresh URL for it"""
+    db.query(models.Profile).filter(models.Profile.id == id).update({
+        models.Profile.avatar: True,
+        models.Profile.avatar_version: models.Profile.avatar_version + 1}, synchronize_session=False)
     db.commit()
+    cache.profiles.invalidate(id)
 
 def get_full_profile(db: Session, id: int):
     return db.query(models.Profile).get(id)
@@ -119,147 +170,367 @@ def create_profile(db: Session, profile: schemas.ProfileCreate) -> models.Profil
     db.refresh(db_profile)
     return db_profile
 
-def create_auth(db: Session, auth: schemas.AuthCreate, profile: schemas, id: str) -> models.Auth:
-    db_auth = models.Auth(email=auth.email, hashed=hash(auth.password), user_id=profile.id, id=id, sent=datetime.today())
-    db.add(db_auth)
-    db.commit()
-    db.refresh(db_auth)
-    return db_auth
-
-def change_auth_id(db: Session, email: str, id: str):
-    old_id = db.query(models.Auth).filter(models.Auth.email == email).first().id
-    db_auth = db.query(models.Auth).get(old_id)
-    db_auth.id = id
-    db.commit()
-
-def change_auth_sent(db: Session, email: str, sent: datetime):
-    old_id = db.query(models.Auth).filter(models.Auth.email == email).first().id
-    db_auth = db.query(models.Auth).get(old_id)
-    db_auth.sent = sent
+def new_token() -> uuid.UUID:
+    return uuid.UUID(bytes=secrets.token_bytes(16))
+
+def with_token(db: Session, write) -> uuid.UUID:
+    """
+    Calls write(token) in a savepoint with a new token until it does not hit the auth primary key, then commits.
+    Uniqueness is left to the constraint instead of looking the token up first
+    """
+    for attempt in range(TOKEN_ATTEMPTS):
+        token = new_token()
+        try:
+            with db.begin_nested():
+                write(token)
+        except IntegrityError as error:
+            if "auth_pkey" in str(error.orig) and attempt < TOKEN_ATTEMPTS - 1:
+                continue
+            raise
+        db.commit()
+        return token
+
+def create_auth(db: Session, auth: schemas.AuthCreate, profile: schemas, hashed: str) -> uuid.UUID:
+    """Adds the auth of the profile, returns its verification token"""
+    return with_token(db, lambda token: db.add(models.Auth(email=auth.email, hashed=hashed, user_id=profile.id, id=token, sent=datetime.today())))
+
+def renew_auth(db: Session, email: str, sent: datetime) -> uuid.UUID:
+    """Replaces the verification token of the email, returns the new one"""
+    return with_token(db, lambda token: db.query(models.Auth).filter(models.Auth.email == email).update({models.Auth.id: token, models.Auth.sent: sent}))
+
+def change_hashed(db: Session, email: str, hashed: str):
+    db.query(models.Auth).filter(models.Auth.email == email).update({models.Auth.hashed: hashed})
     db.commit()
 
 def change_name(db: Session, id: int, name: str):
     profile = db.query(models.Profile).get(id)
     profile.name = name
     db.commit()
+    cache.profiles.invalidate(id)
 
 def change_about(db: Session, id: int, about: str):
     profile = db.query(models.Profile).get(id)
     profile.about = about
     db.commit()
+    cache.profiles.invalidate(id)
 
 def change_status(db: Session, id: int, status: str):
     profile = db.query(models.Profile).get(id)
     profile.status = status
     db.commit()
+    cache.profiles.invalidate(id)
 
 def set_cords(db: Session, id: int, latitude: float, longitude: float):
+    """
+    Stores the position when the user moved more than recommend.MOVE_KM. The pool of the user is dropped,
+    in the pools the user is a candidate in distance and score are recomputed in place
+    """
     profile = db.query(models.Profile).get(id)
+    if profile.latitude is not None and profile.longitude is not None and \
+            geo.haversine(profile.latitude, profile.longitude, latitude, longitude) <= recommend.MOVE_KM:
+        return
     profile.latitude = latitude
     profile.longitude = longitude
+    drop_pool(db, id)
+    owner = aliased(models.Profile)
+    distance = distance_km(latitude, longitude, owner)
+    db.execute(update(models.Candidate).where(models.Candidate.candidate_id == id, owner.id == models.Candidate.user_id, models.Profile.id == models.Candidate.candidate_id).
+               values(distance=distance, score=recommend.scorer(owner, distance)).execution_options(synchronize_session=False))
+    # Candidates that left the radius of a pool
+    radius = cast(models.CandidatePool.filters, JSONB)["radius_km"].astext.cast(Float)
+    db.execute(delete(models.Candidate).where(models.Candidate.candidate_id == id, models.CandidatePool.user_id == models.Candidate.user_id,
+                                              models.Candidate.distance > radius).execution_options(synchronize_session=False))
     db.commit()
-
-def like(db: Session, initiator: id, target: id):
-    db_like = models.Like(initiator=initiator, target=target)
-    db.add(db_like)
+    cache.profiles.invalidate(id)
+
+def lock_pairs(db: Session, pairs: list[tuple[int, int]]):
+    """Serializes swipes between the same two users until the end of the transaction, locks are taken in a fixed order"""
+    keys = sorted({(min(a, b), max(a, b)) for a, b in pairs})
+    db.execute(text("SELECT pg_advisory_xact_lock(low, high) FROM (SELECT * FROM unnest(CAST(:low AS integer[]), CAST(:high AS integer[])) AS pairs(low, high) ORDER BY low, high) AS ordered"),
+               {"low": [low for low, _ in keys], "high": [high for _, high in keys]})
+
+def unlike_counters(db: Session, initiator: int, removed: list):
+    """Counter updates for deleted likes of the initiator, removed holds (target, match) rows"""
+    db.execute(update(models.Profile).where(models.Profile.id.in_([like.target for like in removed])).values(
+        likes_received=models.Profile.likes_received - 1,
+        unseen_likes=func.greatest(models.Profile.unseen_likes - 1, 0)))
+    matched = [like.target for like in removed if like.match]
+    if matched:
+        db.execute(update(models.Profile).where(models.Profile.id.in_(matched)).values(matches=models.Profile.matches - 1))
+        db.execute(update(models.Profile).where(models.Profile.id == initiator).values(matches=models.Profile.matches - len(matched)))
+
+def swipe(db: Session, initiator: int, target: int, action: str) -> tuple[str, int | None]:
+    """
+    Like or dislike in a single transaction. A repeated reaction is removed, the opposite one is replaced,
+    a like on a user who already liked the initiator becomes a match.
+    Returns liked, disliked, deleted or match and, for a new like, the number of likes the target has received
+    """
+    lock_pairs(db, [(initiator, target)])
+    db.execute(delete(models.Candidate).where(models.Candidate.user_id == initiator, models.Candidate.candidate_id == target))
+    own = (models.Like.initiator == initiator, models.Like.target == target)
+    own_dislike = (models.Dislike.initiator == initiator, models.Dislike.target == target)
+    if action == "like":
+        removed = db.execute(delete(models.Like).where(*own).returning(models.Like.target, models.Like.match)).all()
+        if removed:
+            unlike_counters(db, initiator, removed)
+            db.commit()
+            return "deleted", None
+        likes = models.Like.__table__
+        previous = select(likes.c.id, likes.c.match).where(likes.c.initiator == target, likes.c.target == initiator).subquery()
+        reverse = db.execute(update(likes).where(likes.c.id == previous.c.id).values(match=True).returning(previous.c.match)).first()
+        if reverse:
+            if not reverse.match:
+                db.execute(update(models.Profile).where(models.Profile.id.in_((initiator, target))).values(matches=models.Profile.matches + 1))
+            db.execute(delete(models.Dislike).where(*own_dislike))
+            db.commit()
+            return "match", None
+        inserted = insert(models.Like).values(initiator=initiator, target=target, match=False, created=datetime.now()).\
+            on_conflict_do_nothing(index_elements=["initiator", "target"]).returning(models.Like.target).cte("inserted")
+        profiles = models.Profile.__table__
+        likes_received = db.execute(update(profiles).where(profiles.c.id == inserted.c.target).values(
+            likes_received=profiles.c.likes_received + 1,
+            unseen_likes=profiles.c.unseen_likes + 1).returning(profiles.c.likes_received).
+            add_cte(delete(models.Dislike.__table__).where(*own_dislike).cte("undisliked"), inserted)).scalar()
+        db.commit()
+        return "liked", likes_received
+    if db.execute(delete(models.Dislike).where(*own_dislike).returning(models.Dislike.id)).first():
+        db.commit()
+        return "deleted", None
+    removed = db.execute(delete(models.Like).where(*own).returning(models.Like.target, models.Like.match)).all()
+    if removed:
+        unlike_counters(db, initiator, removed)
+    db.execute(insert(models.Dislike).values(initiator=initiator, target=target, created=datetime.now()).on_conflict_do_nothing(index_elements=["initiator", "target"]))
     db.commit()
-    db.refresh(db_like)
-    return db_like
-
-def match(db: Session, initiator: id, target: id):
-    db_like = db.query(models.Like).filter(models.Like.initiator == initiator, models.Like.target == target).first()
-    db_like.match = True
+    return "disliked", None
+
+def swipes(db: Session, initiator: int, decisions: dict[int, str]) -> tuple[list[int], list[int], dict[int, int]]:
+    """
+    Applies a batch of decisions {target: like | dislike} with set-based statements in one transaction.
+    Unlike swipe a repeated decision is kept rather than toggled, unknown targets are skipped.
+    Returns all matches among liked targets, the matches created by this batch
+    and the number of likes received by every newly liked target
+    """
+    targets = set(db.scalars(select(models.Profile.id).where(models.Profile.id.in_(decisions), models.Profile.id != initiator)))
+    if not targets:
+        return [], [], {}
+    lock_pairs(db, [(initiator, target) for target in targets])
+    db.execute(delete(models.Candidate).where(models.Candidate.user_id == initiator, models.Candidate.candidate_id.in_(targets)))
+    likes, dislikes, profiles = models.Like.__table__, models.Dislike.__table__, models.Profile.__table__
+    liked = [target for target in targets if decisions[target] == "like"]
+    disliked = [target for target in targets if decisions[target] == "dislike"]
+    now = datetime.now()
+    if disliked:
+        removed = db.execute(delete(likes).where(likes.c.initiator == initiator, likes.c.target.in_(disliked)).returning(likes.c.target, likes.c.match)).all()
+        if removed:
+            unlike_counters(db, initiator, removed)
+        db.execute(insert(dislikes).values([{"initiator": initiator, "target": target, "created": now} for target in disliked]).
+                   on_conflict_do_nothing(index_elements=["initiator", "target"]))
+    matches, new_matches, likes_received = [], [], {}
+    if liked:
+        db.execute(delete(dislikes).where(dislikes.c.initiator == initiator, dislikes.c.target.in_(liked)))
+        previous = select(likes.c.id, likes.c.initiator, likes.c.match).where(likes.c.target == initiator, likes.c.initiator.in_(liked)).subquery()
+        reverse = db.execute(update(likes).where(likes.c.id == previous.c.id).values(match=True).returning(previous.c.initiator, previous.c.match)).all()
+        matches = [like.initiator for like in reverse]
+        new_matches = [like.initiator for like in reverse if not like.match]
+        if new_matches:
+            db.execute(update(profiles).where(profiles.c.id.in_(new_matches)).values(matches=profiles.c.matches + 1))
+            db.execute(update(profiles).where(profiles.c.id == initiator).values(matches=profiles.c.matches + len(new_matches)))
+        pending = [target for target in liked if target not in set(matches)]
+        if pending:
+            inserted = insert(likes).values([{"initiator": initiator, "target": target, "match": False, "created": now} for target in pending]).\
+                on_conflict_do_nothing(index_elements=["initiator", "target"]).returning(likes.c.target).cte("inserted")
+            likes_received = dict(db.execute(update(profiles).where(profiles.c.id == inserted.c.target).values(
+                likes_received=profiles.c.likes_received + 1,
+                unseen_likes=profiles.c.unseen_likes + 1).returning(profiles.c.id, profiles.c.likes_received).add_cte(inserted)).all())
     db.commit()
-
-def get_like(db: Session, initiator: id, target: id):
-    return db.query(models.Like).filter(models.Like.initiator == initiator, models.Like.target == target).first()
-
-def get_dislike(db: Session, initiator: int, target: int):
-    return db.query(models.Dislike).filter(models.Dislike.initiator == initiator, models.Dislike.target == target).first()
-
-def dislike(db: Session, initiator: id, target: id):
-    db_dislike = models.Dislike(initiator=initiator, target=target)
-    db.add(db_dislike)
-    db.commit()
-    db.refresh(db_dislike)
-    return db_dislike
-    
-def delete_like(db: Session, initiator: int, target: int):
-    like = db.query(models.Like).filter(models.Like.initiator == initiator, models.Like.target == target).first()
-    db.delete(like)
-    db.commit()
-
-def delete_dislike(db: Session, initiator: int, target: int):
-    dislike = db.query(models.Dislike).filter(models.Dislike.initiator == initiator, models.Dislike.target == target).first()
-    db.delete(dislike)
+    return matches, new_matches, likes_received
+
+def get_fcm_tokens(db: Session, ids: list[int]) -> dict[int, str]:
+    return dict(db.query(models.Profile.id, models.Profile.fcm_token).filter(models.Profile.id.in_(ids)).all())
+
+def distance_km(latitude: float, longitude: float, profile=models.Profile):
+    """Haversine distance in kilometres from the given point to the cords of profile (Profile or an alias of it), evaluated in SQL"""
+    profile_latitude = func.radians(profile.latitude)
+    profile_longitude = func.radians(profile.longitude)
+    haversine = func.power(func.sin((profile_latitude - math.radians(latitude)) / 2), 2) + \
+        math.cos(math.radians(latitude)) * func.cos(profile_latitude) * func.power(func.sin((profile_longitude - math.radians(longitude)) / 2), 2)
+    return 2 * EARTH_RADIUS * func.asin(func.sqrt(case((haversine > 1, 1.0), else_=haversine)))
+
+def bounding_box(latitude: float, longitude: float, radius_km: float):
+    """Coarse lat/lon box around the point, lets ix_profiles_cords cut candidates before the exact distance check"""
+    delta_latitude = math.degrees(radius_km / EARTH_RADIUS)
+    conditions = [models.Profile.latitude.between(latitude - delta_latitude, latitude + delta_latitude)]
+    if abs(latitude) + delta_latitude < 90:
+        delta_longitude = math.degrees(math.asin(min(1.0, math.sin(radius_km / EARTH_RADIUS) / math.cos(math.radians(latitude)))))
+        if -180 <= longitude - delta_longitude and longitude + delta_longitude <= 180:
+            conditions.append(models.Profile.longitude.between(longitude - delta_longitude, longitude + delta_longitude))
+    return conditions
+
+def encode_cursor(key: float, id: int) -> str:
+    return base64.urlsafe_b64encode(json.dumps([key, id]).encode()).decode().rstrip('=')
+
+def decode_cursor(cursor: str) -> tuple[float, int]:
+    """Raises ValueError on a cursor that was not produced by encode_cursor"""
+    try:
+        key, id = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        # bool is an int to isinstance
+        if isinstance(key, bool) or not isinstance(key, (int, float)) or isinstance(id, bool) or not isinstance(id, int):
+            raise TypeError(cursor)
+        key = float(key)
+    except (TypeError, ValueError, OverflowError, binascii.Error) as error:
+        raise ValueError("invalid cursor") from error
+    # Scores are finite and ids are int4
+    if not math.isfinite(key) or not -2 ** 31 <= id < 2 ** 31:
+        raise ValueError("invalid cursor")
+    return key, id
+
+def birth_range(agefrom: int, ageto: int):
+    """Profile.age between agefrom and ageto as a range of Profile.birth, which ix_profiles_sex_birth can serve"""
+    return (models.Profile.birth <= func.current_date() - func.make_interval(agefrom),
+            models.Profile.birth > func.current_date() - func.make_interval(ageto + 1))
+
+def build_pool(db: Session, user: models.Profile, filters: dict):
+    """Replaces the candidate pool of the user with the POOL_SIZE best scored profiles matching the filters"""
+    query = select(literal(user.id), models.Profile.id).where(
+        models.Profile.id != user.id, *birth_range(filters["agefrom"], filters["ageto"]),
+        ~exists().where(models.Like.initiator == user.id, models.Like.target == models.Profile.id),
+        ~exists().where(models.Dislike.initiator == user.id, models.Dislike.target == models.Profile.id))
+    if filters["sex"]:
+        query = query.where(models.Profile.sex == filters["sex"])
+    if user.latitude is not None and user.longitude is not None:
+        distance = distance_km(user.latitude, user.longitude)
+        if filters["radius_km"] is not None:
+            query = query.where(*bounding_box(user.latitude, user.longitude, filters["radius_km"]), distance <= filters["radius_km"])
+    else:
+        distance = literal(None, Float)
+    score = recommend.scorer(user, distance)
+    score = score.label("score")
+    query = query.add_columns(score, distance).order_by(score, models.Profile.id).limit(recommend.POOL_SIZE)
+    # Concurrent requests of the user rebuild one after another, lock_pairs never takes 0 as the low key
+    db.execute(text("SELECT pg_advisory_xact_lock(0, :id)"), {"id": user.id})
+    db.execute(delete(models.Candidate).where(models.Candidate.user_id == user.id))
+    size = db.execute(insert(models.Candidate).from_select(["user_id", "candidate_id", "score", "distance"], query)).rowcount
+    pool = {"filters": json.dumps(filters, sort_keys=True), "size": size, "built": datetime.now()}
+    db.execute(insert(models.CandidatePool).values(user_id=user.id, **pool).on_conflict_do_update(index_elements=["user_id"], set_=pool))
     db.commit()
 
-def get_all_profiles(db: Session, id: int, agefrom: int, ageto: int) -> List[models.Profile]:
-    user = db.query(models.Profile).get(id)
-    profiles = db.query(models.Profile).filter(models.Profile.id != id, models.Profile.age >= agefrom, models.Profile.age <= ageto).options(load_only(models.Profile.name, models.Profile.status, models.Profile.age, models.Profile.avatar, models.Profile.latitude, models.Profile.longitude)).all()
+def get_cards(db: Session, id: int, agefrom: int = None, ageto: int = None, sex: str = None, radius_km: float = None, limit: int = 20, cursor: str = None) -> tuple[List[dict], str | None]:
+    """
+    Page of cards from the precomputed candidate pool of the user, ordered by (score, id).
+    Filters left out default to Profile.preferences. The pool is rebuilt when the filters change,
+    when it is older than POOL_TTL, and when a full pool has nothing left past the cursor. A cursor into the previous pool
+    means nothing in the rebuilt one, paging starts over there and candidates skipped without a swipe come back.
+    Returns the cards and the cursor of the next page, None on the last page of a pool that holds every match
+    """
+    user = db.query(models.Profile).options(load_only(models.Profile.latitude, models.Profile.longitude, models.Profile.preferences)).get(id)
+    defaults = recommend.preferences(user.preferences)
+    filters = {"agefrom": agefrom if agefrom is not None else defaults.get("agefrom", 0),
+               "ageto": ageto if ageto is not None else defaults.get("ageto", 2000),
+               "sex": sex if sex is not None else defaults.get("sex"),
+               "radius_km": radius_km}
+    after = decode_cursor(cursor) if cursor else None
+    pool = db.get(models.CandidatePool, id)
+    if not pool or pool.filters != json.dumps(filters, sort_keys=True) or (datetime.now() - pool.built).total_seconds() > recommend.POOL_TTL:
+        build_pool(db, user, filters)
+        pool = db.get(models.CandidatePool, id)
+        after = None
+    query = db.query(models.Candidate.score, models.Candidate.distance, models.Profile.id, models.Profile.name, models.Profile.status, models.Profile.age, models.Profile.avatar,
+                     models.Profile.avatar_version, models.Profile.latitude, models.Profile.longitude).\
+        join(models.Profile, models.Profile.id == models.Candidate.candidate_id).filter(models.Candidate.user_id == id)
+    if after:
+        rows = query.filter(tuple_(models.Candidate.score, models.Candidate.candidate_id) > tuple_(*after))
+    else:
+        rows = query
+    rows = rows.order_by(models.Candidate.score, models.Candidate.candidate_id).limit(limit + 1).all()
+    full = pool.size >= recommend.POOL_SIZE
+    if not rows and full:
+        build_pool(db, user, filters)
+        full = db.get(models.CandidatePool, id).size >= recommend.POOL_SIZE
+        rows = query.order_by(models.Candidate.score, models.Candidate.candidate_id).limit(limit + 1).all()
+    # Pool distances are spherical, the page shows the ellipsoidal ones computed in one batch
+    located = [row for row in rows[:limit] if row.distance is not None and row.latitude is not None]
+    shown = dict(zip((row.id for row in located), geo.vincenty(user.latitude, user.longitude, [row.latitude for row in located], [row.longitude for row in located]))) if located else {}
     result = []
-    for profile in profiles:
-        profile_dict = profile.__dict__
-        if profile_dict['avatar']:
-            profile_dict['avatar'] = media.get_avatar(id)
+    for row in rows[:limit]:
+        profile_dict = {"id": row.id, "name": row.name, "status": row.status, "age": row.age}
+        if row.avatar:
+            profile_dict['avatar'] = media.get_avatar(row.id, "thumb", row.avatar_version)
         else:
             profile_dict['avatar'] = None
-        if profile_dict['longitude'] and profile_dict['latitude'] and user.latitude and user.longitude:
-            profile_dict['distance'] = round(geopy.distance.geodesic((profile_dict['latitude'], profile_dict['longitude']), (user.latitude, user.longitude)).km, 1)
-        del profile_dict['longitude']
-        del profile_dict['latitude']
+        if row.id in shown:
+            profile_dict['distance'] = round(float(shown[row.id]), 1)
         result.append(profile_dict)
-    return result
+    if len(rows) > limit:
+        next_cursor = encode_cursor(rows[limit - 1].score, rows[limit - 1].id)
+    elif rows and full:
+        # More matches than the pool holds, the page after the last one is served from the rebuilt pool
+        next_cursor = encode_cursor(rows[-1].score, rows[-1].id)
+    else:
+        next_cursor = None
+    return result, next_cursor
 
-def get_all_profiles_by_sex(db: Session, id: int, agefrom: int, ageto: int, sex: str) -> List[models.Profile]:
-    user = db.query(models.Profile).get(id)
-    profiles = db.query(models.Profile).filter(models.Profile.id != id, models.Profile.age >= agefrom, models.Profile.age <= ageto, models.Profile.sex == sex).options(load_only(models.Profile.name, models.Profile.status, models.Profile.age, models.Profile.avatar, models.Profile.latitide, models.Profile.longitude)).all()
-    result = []
-    for profile in profiles:
-        profile_dict = profile.__dict__
-        if profile_dict['avatar']:
-            profile_dict['avatar'] = media.get_avatar(id)
-        else:
-            profile_dict['avatar'] = None
-        if profile_dict['longitude'] and profile_dict['latitude'] and user.latitude and user.longitude:
-            geopy.distance.geodesic((profile_dict['latitude'], profile_dict['longitude']), (user.latitude, user.longitude)).km
-            del profile_dict['longitude']
-            del profile_dict['latitude']
-        result.append(profile_dict)
-    return result
+def drop_pool(db: Session, id: int):
+    db.query(models.CandidatePool).filter(models.CandidatePool.user_id == id).delete(synchronize_session=False)
 
-def verify_auth(db: Session, id: str):
+def verify_auth(db: Session, id: uuid.UUID):
     db_auth = db.query(models.Auth).get(id)
     db_auth.verified = True
     db.commit()
 
-def delete_user(db: Session, id: int):
+def delete_user(db: Session, id: int) -> int:
+    """
+    Deletes the profile with its auth, likes, dislikes and messages and records every S3 object
+    of the user in a purge job in the same transaction. Returns the job id, see app.data.purge
+    """
     profile = db.query(models.Profile).filter(models.Profile.id == id).first()
     auth = db.query(models.Auth).filter(models.Auth.user_id == id).first()
     likes_initiator = db.query(models.Like).filter(models.Like.initiator == id).all()
     likes_target = db.query(models.Like).filter(models.Like.target == id).all()
-    dislikes = db.query(models.Dislike).filter(models.Dislike.initiator == id).all()
-    db.delete(profile)
-    db.delete(auth)
+    objects = media.objects("gallery", profile.images or [])
+    if profile.avatar:
+        objects += media.objects("avatars", [str(id) + '.png'])
+    attachments = db.query(func.unnest(models.Messages.attachments)).filter(or_(models.Messages.sender == id, models.Messages.recipient == id))
+    objects += media.objects("chat", [key for key, in attachments])
+    objects += [media.EXPORTS + '/' + key for key, in db.query(models.ExportJob.key).filter(models.ExportJob.user_id == id, models.ExportJob.key.isnot(None))]
+    if likes_initiator:
+        unlike_counters(db, id, likes_initiator)
+    matched = [item.initiator for item in likes_target if item.match]
+    if matched:
+        db.query(models.Profile).filter(models.Profile.id.in_(matched)).update({models.Profile.matches: models.Profile.matches - 1}, synchronize_session=False)
+    db.query(models.Candidate).filter(or_(models.Candidate.user_id == id, models.Candidate.candidate_id == id)).delete(synchronize_session=False)
+    drop_pool(db, id)
+    db.query(models.Messages).filter(or_(models.Messages.sender == id, models.Messages.recipient == id)).delete(synchronize_session=False)
+    db.query(models.Dislike).filter(or_(models.Dislike.initiator == id, models.Dislike.target == id)).delete(synchronize_session=False)
     for item in likes_initiator:
         db.delete(item)
     for item in likes_target:
         db.delete(item)
-    for item in dislikes:
-        db.delete(item)
+    db.delete(profile)
+    db.delete(auth)
+    job = models.PurgeJob(user_id=id, objects=objects)
+    db.add(job)
     db.commit()
+    cache.profiles.invalidate(id)
+    return job.id
 
-def get_verified(db: Session, id: str):
-    return db.query(models.Auth).filter(models.Auth.id == id).first().verified
+def get_purge_job(db: Session, user_id: int) -> models.PurgeJob | None:
+    return db.query(models.PurgeJob).filter(models.PurgeJob.user_id == user_id).order_by(models.PurgeJob.id.desc()).first()
 
-def get_email_verified(db: Session, email: str):
-    return db.query(models.Auth).filter(models.Auth.email == email).first().verified
+def get_unfinished_purge_jobs(db: Session) -> list[int]:
+    return [id for id, in db.query(models.PurgeJob.id).filter(models.PurgeJob.finished.is_(None)).order_by(models.PurgeJob.id)]
 
-def get_auth(db: Session, id: str):
-    return db.query(models.Auth).filter(models.Auth.id == id).first()
+def set_purge_progress(db: Session, id: int, done: int, finished: bool = False):
+    values = {models.PurgeJob.done: done}
+    if finished:
+        values[models.PurgeJob.finished] = datetime.now()
+    db.query(models.PurgeJob).filter(models.PurgeJob.id == id).update(values, synchronize_session=False)
+    db.commit()
 
-def get_email_sent(db: Session, email: str):
-    return db.query(models.Auth).filter(models.Auth.email == email).first().sent
+def get_verified(db: Session, id: uuid.UUID):
+    return db.query(models.Auth).filter(models.Auth.id == id).first().verified
+
+def get_auth(db: Session, id: uuid.UUID):
+    return db.query(models.Auth).filter(models.Auth.id == id).first()
 
 def update_avatar(db: Session, id: int, url: str):
     profile = db.query(models.Profile).get(id)
@@ -274,19 +545,60 @@ def get_likes(db: Session, id: int):
         result.append(like_dict)
     return result
 
-def get_all_likes_name_users(db: Session, id: int):
-    initiator =  db.query(models.Like).filter(models.Like.initiator == id).options(load_only(models.Like.target)).all()
-    target = db.query(models.Like).filter(models.Like.target == id, models.Like.match == True).options(load_only(models.Like.initiator)).all()
-    result = []
-    for likeObject in initiator:
-        result.append((db.query(models.Profile).get(likeObject.target).name, likeObject.created))
-    for likeObject in target:
-        result.append((db.query(models.Profile).get(likeObject.initiator).name, likeObject.created))
-    return result
+def mark_likes_seen(db: Session, id: int):
+    db.query(models.Profile).filter(models.Profile.id == id, models.Profile.unseen_likes != 0).update({models.Profile.unseen_likes: 0}, synchronize_session=False)
+    db.commit()
 
-def get_all_dislikes_name_users(db: Session, id: int):
-    initiator =  db.query(models.Dislike).filter(models.Dislike.initiator == id).options(load_only(models.Dislike.target)).all()
-    result = []
-    for dislikeObject in initiator:
-        result.append((db.query(models.Profile).get(dislikeObject.target).name, dislikeObject.created))
-    return result
\ No newline at end of file
+def reconcile_counters(db: Session):
+    """Recomputes likes_received, matches and unseen_likes of every profile from the likes table"""
+    received = select(func.count()).where(models.Like.target == models.Profile.id).scalar_subquery()
+    matches = select(func.count()).where(models.Like.match == True, or_(models.Like.initiator == models.Profile.id, models.Like.target == models.Profile.id)).scalar_subquery()
+    db.query(models.Profile).update({
+        models.Profile.likes_received: received,
+        models.Profile.matches: matches,
+        models.Profile.unseen_likes: func.least(models.Profile.unseen_likes, received)}, synchronize_session=False)
+    db.commit()
+
+def stream_likes(db: Session, id: int):
+    """Names of users liked by the user and of users whose like became a match, with like dates, streamed like stream_messages"""
+    return db.execute(select(models.Profile.name, models.Like.created).
+                      join(models.Profile, models.Profile.id == case((models.Like.initiator == id, models.Like.target), else_=models.Like.initiator)).
+                      where(or_(models.Like.initiator == id, and_(models.Like.target == id, models.Like.match == True))).
+                      order_by(models.Like.initiator != id, models.Like.created).execution_options(yield_per=STREAM_BATCH))
+
+def stream_dislikes(db: Session, id: int):
+    return db.execute(select(models.Profile.name, models.Dislike.created).
+                      join(models.Profile, models.Profile.id == models.Dislike.target).
+                      where(models.Dislike.initiator == id).order_by(models.Dislike.created).execution_options(yield_per=STREAM_BATCH))
+
+def create_export_job(db: Session, user_id: int, email: str) -> int:
+    job = models.ExportJob(user_id=user_id, email=email)
+    db.add(job)
+    db.commit()
+    return job.id
+
+def claim_export_job(db: Session, id: int, stale: int) -> models.ExportJob | None:
+    """Marks the job running unless it is finished or another worker ran it in the last stale seconds"""
+    now = datetime.now()
+    claimed = db.execute(update(models.ExportJob).where(models.ExportJob.id == id, or_(
+        models.ExportJob.status == "pending",
+        and_(models.ExportJob.status == "running", models.ExportJob.updated < now - timedelta(seconds=stale)))).
+        values(status="running", rows=0, updated=now).returning(models.ExportJob.id)).scalar()
+    db.commit()
+    return db.get(models.ExportJob, id) if claimed else None
+
+def set_export_progress(db: Session, id: int, rows: int):
+    db.query(models.ExportJob).filter(models.ExportJob.id == id).update({models.ExportJob.rows: rows, models.ExportJob.updated: datetime.now()}, synchronize_session=False)
+    db.commit()
+
+def finish_export_job(db: Session, id: int, key: str = None, error: str = None):
+    db.query(models.ExportJob).filter(models.ExportJob.id == id).update({
+        models.ExportJob.status: "failed" if error else "done", models.ExportJob.key: key, models.ExportJob.error: error,
+        models.ExportJob.updated: datetime.now(), models.ExportJob.finished: datetime.now()}, synchronize_session=False)
+    db.commit()
+
+def get_export_job(db: Session, user_id: int) -> models.ExportJob | None:
+    return db.query(models.ExportJob).filter(models.ExportJob.user_id == user_id).order_by(models.ExportJob.id.desc()).first()
+
+def get_unfinished_export_jobs(db: Session) -> list[int]:
+    return [id for id, in db.query(models.ExportJob.id).filter(models.ExportJob.status.in_(("pending", "running"))).order_by(models.ExportJob.id)]
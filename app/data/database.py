@@ -1,8 +1,113 @@
 from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool, AsyncAdaptedQueuePool, NullPool
 from os import environ
+import bisect, threading, time
 
-engine = create_engine(environ["DB_SERVER"])
+# Every gunicorn worker has its own pools, Postgres sees up to workers * (DB_POOL_SIZE + DB_MAX_OVERFLOW) connections per engine
+DB_POOL_SIZE = int(environ.get("DB_POOL_SIZE", 5))
+DB_MAX_OVERFLOW = int(environ.get("DB_MAX_OVERFLOW", 10))
+DB_POOL_TIMEOUT = float(environ.get("DB_POOL_TIMEOUT", 30))
+DB_POOL_RECYCLE = int(environ.get("DB_POOL_RECYCLE", -1))
+DB_POOL_PRE_PING = int(environ.get("DB_POOL_PRE_PING", 0))
+# Behind PgBouncer in transaction mode: no pooling here and no server side prepared statements
+DB_PGBOUNCER = int(environ.get("DB_PGBOUNCER", 0))
+# Upper bounds of the checkout latency histogram in milliseconds
+LATENCY_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 5000)
+
+class PoolMetrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.waiting = 0
+        self.waits = 0
+        self.checkouts = 0
+        self.failed = 0
+        self.latency_sum = 0.0
+        self.latency = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def observe(self, milliseconds: float, failed: bool):
+        with self.lock:
+            self.checkouts += 1
+            self.failed += failed
+            self.latency_sum += milliseconds
+            self.latency[bisect.bisect_left(LATENCY_BUCKETS, milliseconds)] += 1
+
+class Instrumented:
+    """
+    Times every checkout. waiting counts the checkouts blocked right now on an exhausted pool, no idle connection
+    and the overflow used up, waits counts all that ever blocked. Checkouts that open a new connection only show
+    in the checkout_ms histogram
+    """
+    metrics: PoolMetrics
+
+    def exhausted(self) -> bool:
+        """NullPool opens a connection for every checkout and never blocks"""
+        return isinstance(self, QueuePool) and self.checkedin() == 0 and -1 < self._max_overflow <= self.overflow()
+
+    def _do_get(self):
+        started = time.perf_counter()
+        blocked = self.exhausted()
+        if blocked:
+            with self.metrics.lock:
+                self.metrics.waiting += 1
+                self.metrics.waits += 1
+        failed = True
+        try:
+            connection = super()._do_get()
+            failed = False
+            return connection
+        finally:
+            if blocked:
+                with self.metrics.lock:
+                    self.metrics.waiting -= 1
+            self.metrics.observe((time.perf_counter() - started) * 1000, failed)
+
+class InstrumentedQueuePool(Instrumented, QueuePool):
+    metrics = PoolMetrics()
+
+class InstrumentedAsyncQueuePool(Instrumented, AsyncAdaptedQueuePool):
+    metrics = PoolMetrics()
+
+class InstrumentedNullPool(Instrumented, NullPool):
+    metrics = PoolMetrics()
+
+class InstrumentedAsyncNullPool(Instrumented, NullPool):
+    metrics = PoolMetrics()
+
+def pool_options(poolclass, nullclass) -> dict:
+    if DB_PGBOUNCER:
+        return {"poolclass": nullclass, "pool_pre_ping": bool(DB_POOL_PRE_PING)}
+    return {"poolclass": poolclass, "pool_size": DB_POOL_SIZE, "max_overflow": DB_MAX_OVERFLOW, "pool_timeout": DB_POOL_TIMEOUT,
+            "pool_recycle": DB_POOL_RECYCLE, "pool_pre_ping": bool(DB_POOL_PRE_PING)}
+
+engine = create_engine(environ["DB_SERVER"], **pool_options(InstrumentedQueuePool, InstrumentedNullPool))
 base = declarative_base()
-session = sessionmaker(engine)
\ No newline at end of file
+session = sessionmaker(engine)
+
+DB_ASYNC = int(environ.get("DB_ASYNC", 0))
+if DB_ASYNC:
+    async_engine = create_async_engine(environ.get("DB_ASYNC_SERVER", environ["DB_SERVER"].replace("+psycopg2", "+asyncpg")),
+                                       connect_args={"statement_cache_size": 0, "prepared_statement_cache_size": 0} if DB_PGBOUNCER else {},
+                                       **pool_options(InstrumentedAsyncQueuePool, InstrumentedAsyncNullPool))
+    async_session = async_sessionmaker(async_engine, expire_on_commit=False)
+else:
+    async_engine = None
+    async_session = None
+
+def pool_stats(pool) -> dict:
+    metrics = pool.metrics
+    with metrics.lock:
+        result = {"pool": type(pool).__name__, "waiting": metrics.waiting, "waits": metrics.waits, "checkouts": metrics.checkouts, "failed": metrics.failed,
+                  "checkout_ms": {"sum": round(metrics.latency_sum, 3),
+                                  "buckets": {str(bound): count for bound, count in zip(LATENCY_BUCKETS + ("+Inf",), metrics.latency)}}}
+    if isinstance(pool, QueuePool):
+        result.update({"size": pool.size(), "checked_out": pool.checkedout(), "checked_in": pool.checkedin(), "overflow": pool.overflow()})
+    return result
+
+def stats() -> dict:
+    result = {"sync": pool_stats(engine.pool)}
+    if async_engine:
+        result["async"] = pool_stats(async_engine.sync_engine.pool)
+    return result
@@ -0,0 +1,172 @@
+"""
+GDPR exports built off the request path. /gdpr records an export_jobs row and run builds a zip archive of the user
+(profile.json, likes.json, dislikes.json, messages.json, export.html and media.json, the manifest of their images)
+while the rows stream from server side cursors, compressing straight into an S3 multipart upload. Memory stays
+at about one EXPORT_PART_SIZE part whatever the history size. The link to the archive is emailed when it is done
+"""
+from fastapi.concurrency import run_in_threadpool
+from app.auth import mail
+from app.data import crud, media
+from app.data.database import session
+from datetime import datetime, timedelta
+from itertools import chain, groupby
+from os import environ
+import io, json, logging, zipfile
+
+EXPORT_PART_SIZE = int(environ.get("EXPORT_PART_SIZE", 8 * 1024 * 1024))
+EXPORT_URL_EXPIRE = int(environ.get("EXPORT_URL_EXPIRE", 7 * 24 * 3600))
+# A running job without progress for this many seconds is taken over by resume
+EXPORT_STALE = int(environ.get("EXPORT_STALE", 600))
+
+logger = logging.getLogger(__name__)
+
+class MultipartWriter:
+    """Write-only file object over an S3 multipart upload. zipfile sees no seek and writes a streaming archive"""
+    def __init__(self, bucket: str, key: str):
+        self.bucket = bucket
+        self.key = key
+        self.upload = media.s3_client.create_multipart_upload(Bucket=bucket, Key=key, ContentType="application/zip")["UploadId"]
+        self.buffer = io.BytesIO()
+        self.parts = []
+        self.position = 0
+
+    def write(self, data: bytes) -> int:
+        self.buffer.write(data)
+        self.position += len(data)
+        if self.buffer.tell() >= EXPORT_PART_SIZE:
+            self.send()
+        return len(data)
+
+    def tell(self) -> int:
+        return self.position
+
+    def flush(self):
+        pass
+
+    def send(self):
+        number = len(self.parts) + 1
+        response = media.s3_client.upload_part(Bucket=self.bucket, Key=self.key, UploadId=self.upload, PartNumber=number, Body=self.buffer.getvalue())
+        self.parts.append({"ETag": response["ETag"], "PartNumber": number})
+        self.buffer = io.BytesIO()
+
+    def close(self):
+        if self.buffer.tell() or not self.parts:
+            self.send()
+        media.s3_client.complete_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload, MultipartUpload={"Parts": self.parts})
+
+    def abort(self):
+        media.s3_client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload)
+
+class Progress:
+    """
+    Counts exported rows and records them on the job every crud.STREAM_BATCH rows read, which also keeps the job from
+    going stale. export.html and media.json read rows again, they pass count=False and only keep the job fresh
+    """
+    def __init__(self, db, id: int):
+        self.db = db
+        self.id = id
+        self.rows = 0
+        self.read = 0
+
+    def __call__(self, rows, count: bool = True):
+        for row in rows:
+            self.rows += count
+            self.read += 1
+            if self.read % crud.STREAM_BATCH == 0:
+                crud.set_export_progress(self.db, self.id, self.rows)
+            yield row
+
+def write_json(archive: zipfile.ZipFile, name: str, items):
+    """Writes items as a JSON array one element at a time"""
+    with archive.open(name, "w", force_zip64=True) as file:
+        file.write(b"[")
+        for i, item in enumerate(items):
+            file.write((",\n" if i else "\n").encode() + json.dumps(item, default=str, ensure_ascii=False).encode())
+        file.write(b"\n]\n")
+
+def message(row) -> dict:
+    return {"sender": row.sender, "recipient": row.recipient, "message": row.message, "sent": row.sent,
+            "attachments": ' '.join(row.attachments) if row.attachments else None}
+
+def conversations(rows):
+    """Streamed [partner name, messages] pairs as gdpr.html expects them"""
+    for _, group in groupby(rows, key=lambda row: row.partner):
+        first = next(group)
+        yield first.partner_name, map(message, chain([first], group))
+
+def write(db, progress_db, job) -> dict:
+    """Uploads the archive of a claimed job and marks it done, returns what the email needs"""
+    profile = crud.get_full_profile(db, job.user_id)
+    auth = crud.get_auth_profile(db, job.user_id)
+    key = f"{job.user_id}_{job.id}.zip"
+    progress = Progress(progress_db, job.id)
+    writer = MultipartWriter(media.EXPORTS, key)
+    try:
+        with zipfile.ZipFile(writer, "w", zipfile.ZIP_DEFLATED) as archive:
+            about = {"name": profile.name, "birth": profile.birth, "age": profile.age, "sex": profile.sex, "about": profile.about,
+                     "status": profile.status, "preferences": profile.preferences, "email": auth.email, "registered": auth.sent,
+                     "avatar": str(profile.id) + '.png' if profile.avatar else None}
+            archive.writestr("profile.json", json.dumps(about, default=str, ensure_ascii=False, indent=2))
+            write_json(archive, "likes.json", ({"name": name, "created": created} for name, created in progress(crud.stream_likes(db, job.user_id))))
+            write_json(archive, "dislikes.json", ({"name": name, "created": created} for name, created in progress(crud.stream_dislikes(db, job.user_id))))
+            write_json(archive, "messages.json", ({"with": row.partner_name, **message(row)} for row in progress(crud.stream_messages(db, job.user_id))))
+            with archive.open("export.html", "w", force_zip64=True) as file:
+                for chunk in mail.templates.get_template("gdpr.html").generate(
+                        **about, sent=auth.sent, likes=progress(crud.stream_likes(db, job.user_id), False),
+                        dislikes=progress(crud.stream_dislikes(db, job.user_id), False),
+                        messages=conversations(progress(crud.stream_messages(db, job.user_id), False))):
+                    file.write(chunk.encode())
+            media_items = [("avatars", str(profile.id) + '.png')] if profile.avatar else []
+            media_items += [("gallery", image) for image in profile.images or []]
+            attachments = (("chat", image) for image in crud.stream_attachments(db, job.user_id))
+            write_json(archive, "media.json", ({"bucket": bucket, "key": image, "url": media.presign(bucket, image, EXPORT_URL_EXPIRE)}
+                                               for bucket, image in progress(chain(media_items, attachments), False)))
+        writer.close()
+    except BaseException:
+        writer.abort()
+        raise
+    crud.set_export_progress(progress_db, job.id, progress.rows)
+    crud.finish_export_job(progress_db, job.id, key)
+    logger.info("export job %d of user %d wrote %d rows", job.id, job.user_id, progress.rows)
+    return {"email": job.email, "name": profile.name, "link": media.presign(media.EXPORTS, key, EXPORT_URL_EXPIRE),
+            "expires": (datetime.utcnow() + timedelta(seconds=EXPORT_URL_EXPIRE)).strftime("%Y-%m-%d %H:%M")}
+
+def build(id: int) -> dict | None:
+    """Builds the archive of the job, returns what the email needs or None when the job is not ours to run or failed"""
+    db = session()
+    progress_db = session()
+    try:
+        try:
+            job = crud.claim_export_job(progress_db, id, EXPORT_STALE)
+        except Exception:
+            # The job is left as it was, resume or a later claim picks it up
+            logger.exception("claiming export job %d failed", id)
+            return None
+        if not job:
+            return None
+        try:
+            return write(db, progress_db, job)
+        except Exception as error:
+            logger.exception("export job %d failed", id)
+            progress_db.rollback()
+            crud.finish_export_job(progress_db, id, error=str(error))
+            return None
+    finally:
+        db.close()
+        progress_db.close()
+
+async def run(id: int):
+    ready = await run_in_threadpool(build, id)
+    if ready:
+        mail.send("Ваш запрос на получение информации", ready["email"], "gdpr_ready.html", **ready)
+
+def unfinished() -> list[int]:
+    db = session()
+    try:
+        return crud.get_unfinished_export_jobs(db)
+    finally:
+        db.close()
+
+async def resume():
+    for id in await run_in_threadpool(unfinished):
+        await run(id)
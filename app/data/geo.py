@@ -0,0 +1,55 @@
+"""
+Batched distances between one point and arrays of points, in kilometres.
+haversine is the spherical distance used for ranking (same formula as crud.distance_km),
+vincenty is the WGS-84 ellipsoidal distance shown on cards, it agrees with geopy.distance.geodesic to well under a metre
+"""
+import numpy
+
+EARTH_RADIUS = 6371.0088
+# WGS-84
+AXIS_A = 6378.137
+FLATTENING = 1 / 298.257223563
+AXIS_B = AXIS_A * (1 - FLATTENING)
+
+def haversine(latitude: float, longitude: float, latitudes, longitudes) -> numpy.ndarray:
+    latitude, longitude = numpy.radians(latitude), numpy.radians(longitude)
+    latitudes, longitudes = numpy.radians(numpy.asarray(latitudes, dtype=float)), numpy.radians(numpy.asarray(longitudes, dtype=float))
+    h = numpy.sin((latitudes - latitude) / 2) ** 2 + numpy.cos(latitude) * numpy.cos(latitudes) * numpy.sin((longitudes - longitude) / 2) ** 2
+    return 2 * EARTH_RADIUS * numpy.arcsin(numpy.sqrt(numpy.minimum(h, 1.0)))
+
+def vincenty(latitude: float, longitude: float, latitudes, longitudes, iterations: int = 200, tolerance: float = 1e-12) -> numpy.ndarray:
+    """Vincenty inverse formula over all points at once, nearly antipodal points that do not converge fall back to haversine"""
+    latitudes = numpy.asarray(latitudes, dtype=float)
+    longitudes = numpy.asarray(longitudes, dtype=float)
+    L = numpy.radians(longitudes - longitude)
+    U1 = numpy.arctan((1 - FLATTENING) * numpy.tan(numpy.radians(latitude)))
+    U2 = numpy.arctan((1 - FLATTENING) * numpy.tan(numpy.radians(latitudes)))
+    sinU1, cosU1, sinU2, cosU2 = numpy.sin(U1), numpy.cos(U1), numpy.sin(U2), numpy.cos(U2)
+    lam = L.copy()
+    converged = numpy.zeros(L.shape, dtype=bool)
+    with numpy.errstate(invalid="ignore", divide="ignore"):
+        for _ in range(iterations):
+            sin_lam, cos_lam = numpy.sin(lam), numpy.cos(lam)
+            sin_sigma = numpy.hypot(cosU2 * sin_lam, cosU1 * sinU2 - sinU1 * cosU2 * cos_lam)
+            cos_sigma = sinU1 * sinU2 + cosU1 * cosU2 * cos_lam
+            sigma = numpy.arctan2(sin_sigma, cos_sigma)
+            sin_alpha = numpy.where(sin_sigma == 0, 0.0, cosU1 * cosU2 * sin_lam / sin_sigma)
+            cos2_alpha = 1 - sin_alpha ** 2
+            # Points on the equator have cos2_alpha == 0
+            cos_2sigma_m = numpy.where(cos2_alpha == 0, 0.0, cos_sigma - 2 * sinU1 * sinU2 / cos2_alpha)
+            C = FLATTENING / 16 * cos2_alpha * (4 + FLATTENING * (4 - 3 * cos2_alpha))
+            previous = lam
+            lam = L + (1 - C) * FLATTENING * sin_alpha * (sigma + C * sin_sigma * (cos_2sigma_m + C * cos_sigma * (-1 + 2 * cos_2sigma_m ** 2)))
+            converged = numpy.abs(lam - previous) < tolerance
+            if converged.all():
+                break
+        u2 = cos2_alpha * (AXIS_A ** 2 - AXIS_B ** 2) / AXIS_B ** 2
+        A = 1 + u2 / 16384 * (4096 + u2 * (-768 + u2 * (320 - 175 * u2)))
+        B = u2 / 1024 * (256 + u2 * (-128 + u2 * (74 - 47 * u2)))
+        delta_sigma = B * sin_sigma * (cos_2sigma_m + B / 4 * (cos_sigma * (-1 + 2 * cos_2sigma_m ** 2) -
+                                                                B / 6 * cos_2sigma_m * (-3 + 4 * sin_sigma ** 2) * (-3 + 4 * cos_2sigma_m ** 2)))
+        result = AXIS_B * A * (sigma - delta_sigma)
+    fallback = ~converged | ~numpy.isfinite(result)
+    if fallback.any():
+        result[fallback] = haversine(latitude, longitude, latitudes[fallback], longitudes[fallback])
+    return result
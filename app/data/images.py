@@ -0,0 +1,62 @@
+"""
+Decoding and renditions of uploaded images. Decoding runs in a process pool so large photos do not hold the GIL
+of the API workers. Every rendition is re-encoded from pixels only, EXIF, GPS and other metadata are dropped
+"""
+from PIL import Image, ImageOps, UnidentifiedImageError
+from concurrent.futures import ProcessPoolExecutor
+from os import environ
+from typing import BinaryIO
+import io, multiprocessing, threading
+
+FORMAT = environ.get("IMAGE_FORMAT", "WEBP").upper()
+QUALITY = int(environ.get("IMAGE_QUALITY", 80))
+WORKERS = int(environ.get("IMAGE_WORKERS", 2))
+CONTENT_TYPE = {"WEBP": "image/webp", "JPEG": "image/jpeg"}[FORMAT]
+# Longest side in pixels, full keeps the original key, the others are stored under <rendition>/<key>
+RENDITIONS = {"thumb": 256, "card": 1080, "full": 2560}
+Image.MAX_IMAGE_PIXELS = int(environ.get("IMAGE_MAX_PIXELS", 50_000_000))
+
+executor = None
+lock = threading.Lock()
+
+def pool() -> ProcessPoolExecutor:
+    """
+    Started on first use rather than at import, which under gunicorn happens in the master or before the event loop
+    and its threads exist. forkserver children start from a clean process instead of a copy of the API worker
+    """
+    global executor
+    with lock:
+        if executor is None:
+            executor = ProcessPoolExecutor(max_workers=WORKERS, mp_context=multiprocessing.get_context("forkserver"))
+        return executor
+
+class InvalidImage(ValueError):
+    pass
+
+def validate(file: BinaryIO):
+    """Checks the header and structure without decoding the pixels, raises InvalidImage. The file is rewound afterwards"""
+    try:
+        with Image.open(file) as image:
+            image.verify()
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError, SyntaxError) as error:
+        raise InvalidImage(str(error)) from error
+    finally:
+        file.seek(0)
+
+def render(data: bytes) -> dict[str, bytes]:
+    """All renditions of the image encoded in FORMAT, keyed by rendition name"""
+    with Image.open(io.BytesIO(data)) as image:
+        image = ImageOps.exif_transpose(image)
+        if FORMAT == "JPEG" or image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGBA" if FORMAT != "JPEG" and image.has_transparency_data else "RGB")
+        result = {}
+        for name, side in RENDITIONS.items():
+            rendition = image.copy()
+            rendition.thumbnail((side, side), Image.LANCZOS)
+            buffer = io.BytesIO()
+            rendition.save(buffer, FORMAT, quality=QUALITY)
+            result[name] = buffer.getvalue()
+        return result
+
+def key(key: str, rendition: str = "full") -> str:
+    return key if rendition == "full" else rendition + '/' + key
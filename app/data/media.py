@@ -1,51 +1,168 @@
-import boto3, io
+import boto3, botocore.exceptions, threading, time, logging, io
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from tempfile import SpooledTemporaryFile
+from typing import AsyncIterator, BinaryIO
 from os import environ
+from app.data import images
 
 s3_client = boto3.client(endpoint_url="http://s3:8000",
                             aws_access_key_id='quoreapi',
                             aws_secret_access_key=environ["S3_SECRET"],
                             service_name='s3')
 host = "novatorsmobile.ru/s3"
+logger = logging.getLogger(__name__)
 
-def upload_avatar(file: bytes, id: str | int):
-    s3_client.create_bucket(Bucket="avatars")
-    s3_client.upload_fileobj(io.BytesIO(file), "avatars", str(id) + '.png')
+EXPORTS = "exports"
+BUCKETS = ("avatars", "gallery", "chat", EXPORTS)
+UPLOAD_WORKERS = int(environ.get("S3_UPLOAD_WORKERS", 8))
+SPOOL_MEMORY = int(environ.get("S3_SPOOL_MEMORY", 1024 * 1024))
+uploads = ThreadPoolExecutor(max_workers=UPLOAD_WORKERS, thread_name_prefix="s3-upload")
 
-def get_avatar(id: str | int):
+URL_EXPIRE = int(environ.get("S3_URL_EXPIRE", 3600))
+URL_CACHE_SIZE = int(environ.get("S3_URL_CACHE_SIZE", 10000))
+signed = OrderedDict()
+signed_lock = threading.Lock()
+
+def presign(bucket: str, key: str, expire: int = URL_EXPIRE):
     return s3_client.generate_presigned_url('get_object',
-                                                    Params={'Bucket': 'avatars',
-                                                            'Key': str(id) + '.png'},
-                                                    ExpiresIn=60).replace('s3:8000', host).replace('http://', "https://")
+                                                    Params={'Bucket': bucket,
+                                                            'Key': key},
+                                                    ExpiresIn=expire).replace('s3:8000', host).replace('http://', "https://")
 
-def delete_avatar(id: str | int):
-    s3_client.delete_object(Bucket="avatars", Key=str(id) + '.png')
+def sign(bucket: str, keys: list[str], version: int = 0) -> list[str]:
+    """
+    Signed URLs for a batch of keys from one bucket. URLs are cached in an LRU by (bucket, key)
+    and handed out again until half of their lifetime is left, so clients and nginx see the same URL.
+    Keys that are overwritten in place pass their version, an entry signed for another version is signed again
+    """
+    now = time.monotonic()
+    urls = {}
+    with signed_lock:
+        for key in keys:
+            entry = signed.get((bucket, key))
+            if entry and entry[2] == version and entry[1] - now > URL_EXPIRE / 2:
+                signed.move_to_end((bucket, key))
+                urls[key] = entry[0]
+    fresh = {key: presign(bucket, key) for key in keys if key not in urls}
+    if fresh:
+        with signed_lock:
+            for key, url in fresh.items():
+                signed[(bucket, key)] = (url, now + URL_EXPIRE, version)
+                signed.move_to_end((bucket, key))
+            while signed and (len(signed) > URL_CACHE_SIZE or next(iter(signed.values()))[1] - now <= URL_EXPIRE / 2):
+                signed.popitem(last=False)
+        urls.update(fresh)
+    return [urls[key] for key in keys]
 
-def upload_image(file: bytes, id: str | int, count = int):
-    s3_client.create_bucket(Bucket="gallery")
-    s3_client.upload_fileobj(io.BytesIO(file), "gallery", str(id) + '_' + str(count) + '.png')    
+def forget(bucket: str, key: str):
+    with signed_lock:
+        signed.pop((bucket, key), None)
 
-def get_images(filenames: list):
-    return list(map(lambda name: s3_client.generate_presigned_url('get_object',
-                                                    Params={'Bucket': 'gallery',
-                                                            'Key': name},
-                                                    ExpiresIn=60).replace('s3:8000', host).replace('http://', "https://"), filenames))
+def create_bucket(bucket: str):
+    try:
+        s3_client.create_bucket(Bucket=bucket)
+    except (s3_client.exceptions.BucketAlreadyOwnedByYou, s3_client.exceptions.BucketAlreadyExists):
+        pass
 
-def delete_image(filename: str):
-    s3_client.delete_object(Bucket="gallery", Key=filename)
+def create_buckets():
+    """Called once at startup, uploads recreate a bucket themselves if it is missing later"""
+    for bucket in BUCKETS:
+        try:
+            create_bucket(bucket)
+        except (botocore.exceptions.BotoCoreError, botocore.exceptions.ClientError):
+            logger.exception("could not create bucket %s", bucket)
+
+async def spool(stream: AsyncIterator[bytes]) -> SpooledTemporaryFile | None:
+    """Request body in a file kept in memory up to S3_SPOOL_MEMORY bytes and on disk beyond that, None for an empty body"""
+    file = SpooledTemporaryFile(max_size=SPOOL_MEMORY)
+    async for chunk in stream:
+        file.write(chunk)
+    if not file.tell():
+        file.close()
+        return None
+    file.seek(0)
+    return file
+
+def upload(file: BinaryIO, bucket: str, key: str, content_type: str = None):
+    """Streams the file object to S3 in parts and logs how long it took"""
+    size = file.seek(0, 2)
+    file.seek(0)
+    extra = {"ContentType": content_type} if content_type else None
+    started = time.perf_counter()
+    try:
+        s3_client.upload_fileobj(file, bucket, key, ExtraArgs=extra)
+    except botocore.exceptions.ClientError as error:
+        if error.response.get("Error", {}).get("Code") != "NoSuchBucket":
+            raise
+        create_bucket(bucket)
+        file.seek(0)
+        s3_client.upload_fileobj(file, bucket, key, ExtraArgs=extra)
+    forget(bucket, key)
+    logger.info("uploaded %s/%s (%d bytes) in %.1f ms", bucket, key, size, (time.perf_counter() - started) * 1000)
+
+def upload_images(bucket: str, files: dict[str, BinaryIO]):
+    """
+    Renders every image (key -> validated file) on the images process pool, then uploads all renditions concurrently.
+    Keys keep their historical .png names, the actual format is in the ContentType
+    """
+    started = time.perf_counter()
+    rendered = {key: images.pool().submit(images.render, file.read()) for key, file in files.items()}
+    futures = [uploads.submit(upload, io.BytesIO(body), bucket, images.key(key, rendition), images.CONTENT_TYPE)
+               for key, future in rendered.items() for rendition, body in future.result().items()]
+    for future in futures:
+        future.result()
+    logger.info("processed %d images into %s in %.1f ms", len(files), bucket, (time.perf_counter() - started) * 1000)
+
+DELETE_BATCH = 1000
+
+def objects(bucket: str, keys: list[str]) -> list[str]:
+    """The stored objects of the keys as bucket/key, renditions included"""
+    return [bucket + '/' + images.key(key, rendition) for key in keys for rendition in images.RENDITIONS]
 
-def delete_all_images(filenames: list):
-    map(lambda name: s3_client.delete_object(Bucket="gallery", Key=name), filenames)
+def delete_objects(batch: list[str]):
+    """Deletes up to DELETE_BATCH bucket/key objects, one delete_objects call per bucket. Missing objects are not an error"""
+    buckets = {}
+    for item in batch:
+        bucket, key = item.split('/', 1)
+        buckets.setdefault(bucket, []).append(key)
+    for bucket, keys in buckets.items():
+        response = s3_client.delete_objects(Bucket=bucket, Delete={"Objects": [{"Key": key} for key in keys], "Quiet": True})
+        if response.get("Errors"):
+            raise RuntimeError(f"could not delete {len(response['Errors'])} objects from {bucket}: {response['Errors'][0]}")
+        for key in keys:
+            forget(bucket, key)
+
+def delete(bucket: str, keys: list[str]):
+    """Deletes the objects together with all their renditions"""
+    items = objects(bucket, keys)
+    for start in range(0, len(items), DELETE_BATCH):
+        delete_objects(items[start:start + DELETE_BATCH])
+
+def upload_avatar(file: BinaryIO, id: str | int):
+    """Takes ownership of the file, called as a background task"""
+    with file:
+        upload_images("avatars", {str(id) + '.png': file})
+
+def get_avatar(id: str | int, rendition: str = "full", version: int = 0):
+    return sign("avatars", [images.key(str(id) + '.png', rendition)], version)[0]
+
+def upload_image(file: BinaryIO, id: str | int, count = int):
+    """Takes ownership of the file, called as a background task"""
+    with file:
+        upload_images("gallery", {str(id) + '_' + str(count) + '.png': file})
+
+def get_images(filenames: list, rendition: str = "full"):
+    return sign("gallery", [images.key(filename, rendition) for filename in filenames])
+
+def delete_image(filename: str):
+    delete("gallery", [filename])
 
-def upload_chat(files: list[bytes], id: str | int):
-    s3_client.create_bucket(Bucket="chat")
-    result = []
-    for i in range(len(files)):
-        s3_client.upload_fileobj(io.BytesIO(files[i]), "chat", str(id) + '_' + str(i) + '.png')
-        result.append(str(id) + '_' + str(i) + '.png')
+def upload_chat(files: list[BinaryIO], id: str | int):
+    """Attachments are processed and uploaded concurrently, a message costs about one upload"""
+    result = [str(id) + '_' + str(i) + '.png' for i in range(len(files))]
+    upload_images("chat", dict(zip(result, files)))
     return result
 
-def get_chat(filenames: list):
-    return list(map(lambda name: s3_client.generate_presigned_url('get_object',
-                                                    Params={'Bucket': 'chat',
-                                                            'Key': name},
-                                                    ExpiresIn=60).replace('s3:8000', host).replace('http://', "https://"), filenames))
\ No newline at end of file
+def get_chat(filenames: list, rendition: str = "full"):
+    return sign("chat", [images.key(filename, rendition) for filename in filenames])
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Boolean, Float, Date, ForeignKey, CheckConstraint, DateTime, extract, func, ARRAY
+from sqlalchemy import Column, Integer, String, Boolean, Float, Date, ForeignKey, CheckConstraint, DateTime, Index, extract, func, ARRAY, Uuid
 from sqlalchemy.orm import relationship, column_property
 import datetime
 from app.data import database
@@ -20,12 +20,24 @@ class Profile(database.base):
     latitude = Column(Float(), nullable=True, default=None)
     longitude = Column(Float(), nullable=True, default=None)
     fcm_token = Column(String(), nullable=False)
+    likes_received = Column(Integer(), nullable=False, default=0, server_default="0")
+    unseen_likes = Column(Integer(), nullable=False, default=0, server_default="0")
+    matches = Column(Integer(), nullable=False, default=0, server_default="0")
+    # Bumped on every new avatar, the avatar key is reused so signed URLs are cached per version
+    avatar_version = Column(Integer(), nullable=False, default=0, server_default="0")
     auth = relationship("Auth")
 
+    __table_args__ = (
+        Index("ix_profiles_cords", "latitude", "longitude"),
+        Index("ix_profiles_sex_birth", "sex", "birth"),
+        Index("ix_profiles_fcm_token", "fcm_token"),
+    )
+
 class Auth(database.base):
     __tablename__ = 'auth'
 
-    id = Column(String(), primary_key=True, unique=True)
+    # Verification token, 16 random bytes from crud.new_token
+    id = Column(Uuid(), primary_key=True)
     verified = Column(Boolean(), default=False, nullable=False)
     email = Column(String(), CheckConstraint("email LIKE '%@%.%'"), nullable=False, unique=True)
     hashed = Column(String(), nullable=False)   
@@ -33,6 +45,10 @@ class Auth(database.base):
     user_id = Column(Integer(), ForeignKey("profiles.id"))
     user = relationship("Profile")
 
+    __table_args__ = (
+        Index("ix_auth_user", "user_id"),
+    )
+
 class Like(database.base):
     __tablename__ = 'likes'
 
@@ -42,6 +58,11 @@ class Like(database.base):
     match = Column(Boolean(), default=False)
     created = Column(DateTime(), nullable=False, default=datetime.datetime.now)
 
+    __table_args__ = (
+        Index("ux_likes_pair", "initiator", "target", unique=True),
+        Index("ix_likes_target", "target", "initiator"),
+    )
+
 class Dislike(database.base):
     __tablename__ = "dislikes"
 
@@ -50,6 +71,11 @@ class Dislike(database.base):
     target = Column(Integer(), ForeignKey('profiles.id'))
     created = Column(DateTime(), nullable=False, default=datetime.datetime.now)
 
+    __table_args__ = (
+        Index("ux_dislikes_pair", "initiator", "target", unique=True),
+        Index("ix_dislikes_target", "target"),
+    )
+
 class Messages(database.base):
     __tablename__ = "messages"
 
@@ -58,4 +84,65 @@ class Messages(database.base):
     recipient = Column(Integer(), ForeignKey('profiles.id'))
     sent = Column(DateTime(), nullable=False, default=datetime.datetime.now)
     message = Column(String(), nullable=True)
-    attachments = Column(ARRAY(String), default=[])
\ No newline at end of file
+    attachments = Column(ARRAY(String), default=[])
+
+    __table_args__ = (
+        Index("ix_messages_conversation", func.least(sender, recipient), func.greatest(sender, recipient), id),
+        Index("ix_messages_sender", "sender", "recipient"),
+        Index("ix_messages_recipient", "recipient", "sender"),
+    )
+
+class CandidatePool(database.base):
+    __tablename__ = "candidate_pools"
+
+    user_id = Column(Integer(), ForeignKey('profiles.id'), primary_key=True)
+    filters = Column(String(), nullable=False)
+    size = Column(Integer(), nullable=False)
+    built = Column(DateTime(), nullable=False, default=datetime.datetime.now)
+
+class Candidate(database.base):
+    __tablename__ = "candidates"
+
+    user_id = Column(Integer(), ForeignKey('profiles.id'), primary_key=True)
+    candidate_id = Column(Integer(), ForeignKey('profiles.id'), primary_key=True)
+    score = Column(Float(), nullable=False)
+    distance = Column(Float(), nullable=True)
+
+    __table_args__ = (
+        Index("ix_candidates_rank", "user_id", "score", "candidate_id"),
+        Index("ix_candidates_candidate", "candidate_id"),
+    )
+
+class PurgeJob(database.base):
+    __tablename__ = "purge_jobs"
+
+    id = Column(Integer(), primary_key=True, unique=True, autoincrement=True)
+    # Not a foreign key, the profile is deleted when the job is created
+    user_id = Column(Integer(), nullable=False)
+    objects = Column(ARRAY(String), nullable=False, default=[])
+    done = Column(Integer(), nullable=False, default=0)
+    created = Column(DateTime(), nullable=False, default=datetime.datetime.now)
+    finished = Column(DateTime(), nullable=True)
+
+    __table_args__ = (
+        Index("ix_purge_jobs_user", "user_id"),
+    )
+
+class ExportJob(database.base):
+    __tablename__ = "export_jobs"
+
+    id = Column(Integer(), primary_key=True, unique=True, autoincrement=True)
+    # Not a foreign key, the archive outlives a deleted profile until its purge job removes it
+    user_id = Column(Integer(), nullable=False)
+    email = Column(String(), nullable=False)
+    status = Column(String(), nullable=False, default="pending")
+    rows = Column(Integer(), nullable=False, default=0)
+    key = Column(String(), nullable=True)
+    error = Column(String(), nullable=True)
+    created = Column(DateTime(), nullable=False, default=datetime.datetime.now)
+    updated = Column(DateTime(), nullable=False, default=datetime.datetime.now)
+    finished = Column(DateTime(), nullable=True)
+
+    __table_args__ = (
+        Index("ix_export_jobs_user", "user_id"),
+    )
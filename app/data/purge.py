@@ -0,0 +1,50 @@
+"""
+Removal of the S3 objects of deleted accounts. crud.delete_user snapshots the object keys into purge_jobs,
+run deletes them in delete_objects batches of media.DELETE_BATCH keys, PURGE_WORKERS batches at a time on a pool
+of its own so uploads never queue behind a large purge, and records how many keys are gone after every batch.
+Deleting a missing object succeeds, so a job interrupted at any point is simply run again from its recorded progress
+by resume on the next startup
+"""
+from concurrent.futures import ThreadPoolExecutor
+from os import environ
+from sqlalchemy import text
+from app.data import crud, media, models
+from app.data.database import engine, session
+import logging
+
+PURGE_WORKERS = int(environ.get("S3_PURGE_WORKERS", 2))
+deletes = ThreadPoolExecutor(max_workers=PURGE_WORKERS, thread_name_prefix="s3-purge")
+logger = logging.getLogger(__name__)
+
+def run(id: int):
+    # Session level lock on a dedicated connection, other workers resuming the same job skip it
+    with engine.connect() as lock:
+        if not lock.execute(text("SELECT pg_try_advisory_lock(:id)"), {"id": id}).scalar():
+            return
+        db = session()
+        try:
+            job = db.get(models.PurgeJob, id)
+            if not job or job.finished:
+                return
+            objects, done = job.objects, job.done
+            batches = [objects[start:start + media.DELETE_BATCH] for start in range(done, len(objects), media.DELETE_BATCH)]
+            # map yields in order, so done only ever covers a prefix of objects that is fully deleted
+            for batch, _ in zip(batches, deletes.map(media.delete_objects, batches)):
+                done += len(batch)
+                crud.set_purge_progress(db, id, done)
+            crud.set_purge_progress(db, id, done, finished=True)
+            logger.info("purge job %d of user %d removed %d objects", id, job.user_id, len(objects))
+        except Exception:
+            logger.exception("purge job %d stopped, it is resumed on the next startup", id)
+        finally:
+            db.close()
+            lock.execute(text("SELECT pg_advisory_unlock(:id)"), {"id": id})
+
+def resume():
+    db = session()
+    try:
+        jobs = crud.get_unfinished_purge_jobs(db)
+    finally:
+        db.close()
+    for id in jobs:
+        run(id)
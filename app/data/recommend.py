@@ -0,0 +1,49 @@
+"""
+Scoring for the precomputed /cards candidate pools (see crud.build_pool).
+A scorer maps the user and the SQL distance expression to a SQL expression, candidates are served in ascending score.
+New scorers are added to scorers and selected with RECOMMEND_SCORER, the serving path does not change.
+"""
+from sqlalchemy import func, case, exists
+from app.data import models
+from os import environ
+import json
+
+UNKNOWN_DISTANCE = 1e6
+POOL_SIZE = int(environ.get("RECOMMEND_POOL_SIZE", 1000))
+POOL_TTL = int(environ.get("RECOMMEND_POOL_TTL", 3600))
+# GPS fixes jitter between requests, a user counts as moved past this many kilometres
+MOVE_KM = float(environ.get("RECOMMEND_MOVE_KM", 1))
+# Same bound as the /cards query parameters, keeps crud.birth_range inside the date range of Postgres
+AGE_MAX = 150
+
+def by_distance(user: models.Profile, distance):
+    return func.coalesce(distance, UNKNOWN_DISTANCE)
+
+def by_recency(user: models.Profile, distance):
+    """Newest profiles first"""
+    return -models.Profile.id
+
+def by_mutual(user: models.Profile, distance):
+    """Distance, halved for candidates who already liked the user"""
+    liked_user = exists().where(models.Like.initiator == models.Profile.id, models.Like.target == user.id)
+    return func.coalesce(distance, UNKNOWN_DISTANCE) * case((liked_user, 0.5), else_=1.0)
+
+scorers = {
+    "distance": by_distance,
+    "recency": by_recency,
+    "mutual": by_mutual,
+}
+scorer = scorers[environ.get("RECOMMEND_SCORER", "distance")]
+
+def preferences(raw: str | None) -> dict:
+    """Profile.preferences as a dict, the agefrom, ageto and sex keys are used as /cards filter defaults. Ages that are not in 0..AGE_MAX are left out"""
+    try:
+        parsed = json.loads(raw) if raw else {}
+    except ValueError:
+        return {}
+    if not isinstance(parsed, dict):
+        return {}
+    for key in ("agefrom", "ageto"):
+        if key in parsed and not (type(parsed[key]) is int and 0 <= parsed[key] <= AGE_MAX):
+            del parsed[key]
+    return parsed
@@ -0,0 +1,16 @@
+"""
+Reconciliation of the like counters on profiles (likes_received, unseen_likes, matches).
+Recomputes them from the likes table, the columns come from the migrations.
+Safe to run again whenever the counters are suspected to drift:
+
+    python -m app.data.reconcile
+"""
+from app.data import crud
+from app.data.database import session
+
+if __name__ == "__main__":
+    db = session()
+    try:
+        crud.reconcile_counters(db)
+    finally:
+        db.close()
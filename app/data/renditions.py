@@ -0,0 +1,20 @@
+"""
+Backfill of the thumb/ and card/ renditions for images uploaded before the processing pipeline existed.
+Originals are re-encoded in place as well, which strips their metadata. Safe to run again, images that
+already have a thumbnail are skipped:
+
+    python -m app.data.renditions
+"""
+from app.data import media, images
+import io
+
+if __name__ == "__main__":
+    paginator = media.s3_client.get_paginator("list_objects_v2")
+    for bucket in ("avatars", "gallery", "chat"):
+        keys = set()
+        for page in paginator.paginate(Bucket=bucket):
+            keys.update(item["Key"] for item in page.get("Contents", []))
+        missing = [key for key in keys if "/" not in key and images.key(key, "thumb") not in keys]
+        for start in range(0, len(missing), images.WORKERS * 4):
+            batch = missing[start:start + images.WORKERS * 4]
+            media.upload_images(bucket, {key: io.BytesIO(media.s3_client.get_object(Bucket=bucket, Key=key)["Body"].read()) for key in batch})
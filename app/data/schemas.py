@@ -1,5 +1,6 @@
 from pydantic import BaseModel
 from datetime import date
+from typing import Literal
 
 class ProfileCreate(BaseModel):
     name: str
@@ -17,4 +18,8 @@ class AuthCreate(BaseModel):
     password: str
 
     class Config:
-        from_attributes = True
\ No newline at end of file
+        from_attributes = True
+
+class Swipe(BaseModel):
+    target: int
+    action: Literal["like", "dislike"]
@@ -0,0 +1,142 @@
+"""
+Real-time delivery of chat messages to connected WebSocket clients.
+Messages are published to a backend that fans them out to the hub of every worker,
+each hub pushes them to the connections of the recipient it holds.
+"""
+from collections import defaultdict
+from fastapi import WebSocket
+from fastapi.encoders import jsonable_encoder
+from os import environ
+import asyncio, json, asyncpg, logging
+
+NOTIFY_LIMIT = 7900
+BACKOFF = 1
+BACKOFF_MAX = 30
+SEND_TIMEOUT = float(environ.get("CHAT_SEND_TIMEOUT", 5))
+
+logger = logging.getLogger(__name__)
+
+class Backend:
+    def __init__(self):
+        # The event loop only keeps weak references to tasks
+        self.tasks = set()
+
+    def spawn(self, coroutine):
+        task = asyncio.create_task(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+class MemoryBackend(Backend):
+    """Fan-out inside a single process, delivery runs in a task so the publisher does not wait for the sockets"""
+    async def start(self, receiver):
+        self.receiver = receiver
+
+    async def stop(self):
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+    async def publish(self, payload: str):
+        self.spawn(self.receiver(payload))
+
+class PostgresBackend(Backend):
+    """
+    Fan-out between workers through LISTEN/NOTIFY on the database they already share. When the connection drops
+    it is reopened with backoff and LISTEN is issued again, notifications sent in between are missed
+    and the clients catch up through GET /chat
+    """
+    channel = "chat"
+
+    def __init__(self, dsn: str):
+        super().__init__()
+        self.dsn = dsn
+        self.lock = asyncio.Lock()
+        self.connection = None
+        self.stopping = False
+
+    async def connect(self):
+        self.connection = await asyncpg.connect(self.dsn)
+        self.connection.add_termination_listener(self.terminated)
+        await self.connection.add_listener(self.channel, lambda connection, pid, channel, payload: self.spawn(self.receiver(payload)))
+
+    def terminated(self, connection):
+        if not self.stopping:
+            logger.warning("Lost the LISTEN connection, reconnecting")
+            self.spawn(self.reconnect())
+
+    async def reconnect(self):
+        delay = BACKOFF
+        while not self.stopping:
+            try:
+                async with self.lock:
+                    if self.connection.is_closed():
+                        await self.connect()
+                return
+            except (OSError, asyncpg.PostgresError):
+                logger.exception("Reconnecting the LISTEN connection failed, retrying in %.0f s", delay)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, BACKOFF_MAX)
+
+    async def start(self, receiver):
+        self.receiver = receiver
+        await self.connect()
+
+    async def stop(self):
+        self.stopping = True
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        await self.connection.close()
+
+    async def publish(self, payload: str):
+        async with self.lock:
+            if self.connection.is_closed():
+                await self.connect()
+            await self.connection.execute("SELECT pg_notify($1, $2)", self.channel, payload)
+
+class Hub:
+    def __init__(self, backend):
+        self.backend = backend
+        self.connections = defaultdict(set)
+
+    async def start(self):
+        await self.backend.start(self.receive)
+
+    async def stop(self):
+        await self.backend.stop()
+
+    def connect(self, id: int, websocket: WebSocket):
+        self.connections[id].add(websocket)
+
+    def disconnect(self, id: int, websocket: WebSocket):
+        self.connections[id].discard(websocket)
+        if not self.connections[id]:
+            del self.connections[id]
+
+    async def publish(self, recipient: int, message: dict):
+        payload = json.dumps({"recipient": recipient, "message": jsonable_encoder(message)})
+        if len(payload.encode()) > NOTIFY_LIMIT:
+            # Too large for NOTIFY, the client fetches the message through GET /chat
+            payload = json.dumps({"recipient": recipient, "message": {"id": message["id"], "sender": message["sender"], "truncated": True}})
+        await self.backend.publish(payload)
+
+    async def send(self, id: int, websocket: WebSocket, text: str):
+        """A socket that fails or does not take the message within SEND_TIMEOUT is dropped, the client catches up through GET /chat"""
+        try:
+            await asyncio.wait_for(websocket.send_text(text), SEND_TIMEOUT)
+        except Exception:
+            self.disconnect(id, websocket)
+            try:
+                await asyncio.wait_for(websocket.close(), SEND_TIMEOUT)
+            except Exception:
+                pass
+
+    async def receive(self, payload: str):
+        data = json.loads(payload)
+        websockets = list(self.connections.get(data["recipient"], ()))
+        text = json.dumps(data["message"])
+        await asyncio.gather(*(self.send(data["recipient"], websocket, text) for websocket in websockets))
+
+# The image runs several workers, memory only reaches the sockets of the worker that took POST /chat
+if environ.get("CHAT_BACKEND", "postgres") == "memory":
+    hub = Hub(MemoryBackend())
+else:
+    hub = Hub(PostgresBackend(environ["DB_SERVER"].replace("+psycopg2", "")))
@@ -1,24 +1,140 @@
-import firebase_admin
-from firebase_admin import credentials
-import firebase_admin.messaging
+"""
+Notification outbox. Handlers enqueue notifications and return immediately, a background dispatcher
+coalesces duplicates per recipient, sends them in multicast batches, retries transient failures
+with backoff and clears fcm_token of devices FCM reports as unregistered.
+"""
+from app.data import crud
+from app.data.database import session
+from os import environ
+import asyncio, json, logging, random
 
-cred = credentials.Certificate('app/notify/firebase.json')
-firebase_admin.initialize_app(cred)
+MULTICAST_LIMIT = 500
+COALESCE_WINDOW = float(environ.get("FCM_COALESCE_WINDOW", 0.2))
+RETRIES = int(environ.get("FCM_RETRIES", 4))
+BACKOFF = 0.5
+
+logger = logging.getLogger(__name__)
+
+class FirebaseTransport:
+    def __init__(self):
+        import firebase_admin
+        from firebase_admin import credentials
+        import firebase_admin.messaging
+        cred = credentials.Certificate('app/notify/firebase.json')
+        firebase_admin.initialize_app(cred)
+        self.messaging = firebase_admin.messaging
+
+    def send(self, title: str, msg: str, data: dict, tokens: list[str]) -> tuple[list[str], list[str]]:
+        """Sends one multicast, returns the tokens to prune and the tokens to retry"""
+        message = self.messaging.MulticastMessage(
+            notification=self.messaging.Notification(title=title, body=msg) if title else None,
+            data=data,
+            tokens=tokens
+        )
+        response = self.messaging.send_each_for_multicast(message)
+        invalid, retry = [], []
+        for token, result in zip(tokens, response.responses):
+            if result.success:
+                continue
+            if isinstance(result.exception, (self.messaging.UnregisteredError, self.messaging.SenderIdMismatchError)):
+                invalid.append(token)
+            elif getattr(result.exception, "code", None) in ("UNAVAILABLE", "INTERNAL", "RESOURCE_EXHAUSTED", "UNKNOWN"):
+                retry.append(token)
+            else:
+                logger.warning("FCM rejected a token: %s", result.exception)
+        return invalid, retry
+
+class FakeTransport:
+    """Records multicasts instead of sending them, tokens listed in invalid are reported as unregistered"""
+    def __init__(self):
+        self.sent = []
+        self.invalid = set()
+
+    def send(self, title: str, msg: str, data: dict, tokens: list[str]) -> tuple[list[str], list[str]]:
+        self.sent.append((title, msg, data, list(tokens)))
+        return [token for token in tokens if token in self.invalid], []
+
+class Dispatcher:
+    def __init__(self, transport):
+        self.transport = transport
+        self.queue = asyncio.Queue()
+        self.task = None
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self, timeout: float = 5):
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Dropping %d queued notifications on shutdown", self.queue.qsize())
+        self.task.cancel()
+
+    def enqueue(self, title: str, msg: str, tokens, obj: dict = None, attempt: int = 0):
+        tokens = [token for token in tokens if token]
+        if tokens:
+            self.queue.put_nowait((title, msg, obj, tokens, attempt))
+
+    async def run(self):
+        while True:
+            batch = [await self.queue.get()]
+            await asyncio.sleep(COALESCE_WINDOW)
+            while not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            try:
+                await self.dispatch(batch)
+            except Exception:
+                logger.exception("Notification dispatch failed")
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    async def dispatch(self, batch: list):
+        # The same notification for the same device is sent once, the remaining ones are grouped by content
+        groups = {}
+        for title, msg, obj, tokens, attempt in batch:
+            key = (title, msg, json.dumps(obj, sort_keys=True) if obj else None)
+            group = groups.setdefault(key, {"obj": obj, "tokens": {}, "attempt": 0})
+            group["attempt"] = max(group["attempt"], attempt)
+            for token in tokens:
+                group["tokens"][token] = None
+        invalid = []
+        for (title, msg, _), group in groups.items():
+            tokens = list(group["tokens"])
+            for i in range(0, len(tokens), MULTICAST_LIMIT):
+                chunk = tokens[i:i + MULTICAST_LIMIT]
+                try:
+                    rejected, retry = await asyncio.to_thread(self.transport.send, title, msg, group["obj"], chunk)
+                except Exception:
+                    logger.exception("Multicast failed")
+                    rejected, retry = [], chunk
+                invalid += rejected
+                if retry:
+                    self.retry(title, msg, group["obj"], retry, group["attempt"] + 1)
+        if invalid:
+            await asyncio.to_thread(prune, invalid)
+
+    def retry(self, title: str, msg: str, obj: dict, tokens: list[str], attempt: int):
+        if attempt > RETRIES:
+            logger.warning("Giving up on %d notifications after %d attempts", len(tokens), attempt)
+            return
+        delay = BACKOFF * 2 ** (attempt - 1) * (1 + random.random())
+        asyncio.get_running_loop().call_later(delay, self.enqueue, title, msg, tokens, obj, attempt)
+
+def prune(tokens: list[str]):
+    db = session()
+    try:
+        crud.clear_fcm_tokens(db, tokens)
+    finally:
+        db.close()
+
+if environ.get("FCM_TRANSPORT", "firebase") == "fake":
+    dispatcher = Dispatcher(FakeTransport())
+else:
+    dispatcher = Dispatcher(FirebaseTransport())
 
 def sendNotification(title: str, msg: str, tokens, obj=None):
-    message = firebase_admin.messaging.MulticastMessage(
-        notification=firebase_admin.messaging.Notification(
-            title=title,
-            body=msg
-        ),
-        data=obj,
-        tokens=tokens
-    )
-    firebase_admin.messaging.send_multicast(message)
+    dispatcher.enqueue(title, msg, tokens, obj)
 
 def sendMessage(tokens, obj=None):
-    message = firebase_admin.messaging.MulticastMessage(
-        data=obj,
-        tokens=tokens
-    )
-    firebase_admin.messaging.send_multicast(message)
\ No newline at end of file
+    dispatcher.enqueue(None, None, tokens, obj)
@@ -0,0 +1,46 @@
+"""
+Micro-benchmark of app.data.geo against the per-profile geopy.distance.geodesic loop /cards used to run,
+at 1k, 10k and 100k candidates around Moscow. Needs no database. geopy is optional, without it only geo is timed,
+with it the share of distances whose one-decimal rounding differs from geodesic is printed too
+
+    python -m benchmarks.distances
+"""
+import numpy, time
+from app.data import geo
+
+try:
+    from geopy.distance import geodesic
+except ImportError:
+    geodesic = None
+
+SIZES = (1000, 10000, 100000)
+REPEAT = 5
+
+def best(function, repeat: int = REPEAT) -> float:
+    """Best of repeat runs in milliseconds"""
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - started)
+    return min(timings) * 1000
+
+if __name__ == "__main__":
+    random = numpy.random.default_rng(0)
+    latitude, longitude = 55.75, 37.62
+    for size in SIZES:
+        latitudes = latitude + random.uniform(-2, 2, size)
+        longitudes = longitude + random.uniform(-2, 2, size)
+        line = f"{size:>7} candidates: haversine {best(lambda: geo.haversine(latitude, longitude, latitudes, longitudes)):8.2f} ms  " \
+               f"vincenty {best(lambda: geo.vincenty(latitude, longitude, latitudes, longitudes)):8.2f} ms"
+        if geodesic:
+            points = list(zip(latitudes.tolist(), longitudes.tolist()))
+            # The loop takes seconds at 100k, it runs once there
+            loop = best(lambda: [geodesic((latitude, longitude), point).km for point in points], REPEAT if size <= 10000 else 1)
+            expected = numpy.array([round(geodesic((latitude, longitude), point).km, 1) for point in points[:10000]])
+            shown = numpy.round(geo.vincenty(latitude, longitude, latitudes[:10000], longitudes[:10000]), 1)
+            line += f"  geopy loop {loop:8.2f} ms"
+            line += f"  rounding differs for {numpy.mean(expected != shown):.2%}"
+        print(line)
+    if not geodesic:
+        print("geopy is not installed, the geodesic loop was not timed")
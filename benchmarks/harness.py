@@ -0,0 +1,101 @@
+"""
+Shared setup of the benchmarks. They run the app in process against the Postgres database given by BENCH_DB_SERVER,
+whose public schema is dropped and migrated from scratch, so never point it at real data. S3 is replaced by MemoryS3,
+mail and push notifications use the fake transports unless the benchmark picks otherwise
+"""
+from os import environ
+import sys, time
+
+def configure(**overrides):
+    """Environment of the app, call before anything from app or main is imported"""
+    if "BENCH_DB_SERVER" not in environ:
+        sys.exit("BENCH_DB_SERVER is not set")
+    environ["DB_SERVER"] = environ["BENCH_DB_SERVER"]
+    for name in ("S3_SECRET", "JWT_ACCESS_SECRET", "JWT_REFRESH_SECRET", "MAIL_USERNAME", "MAIL_PASSWORD", "MAIL_SERVER"):
+        environ.setdefault(name, "benchmark")
+    environ.setdefault("MAIL_FROM", "benchmark@quore.test")
+    environ.update({"DEBUG": "1", "MAIL_TRANSPORT": "fake", "FCM_TRANSPORT": "fake", "CHAT_BACKEND": "memory", "PROFILE_CACHE": "none"})
+    environ.update(overrides)
+    from app.data import media
+    media.s3_client = MemoryS3()
+
+def reset():
+    """Empty database at the latest migration"""
+    from alembic import command
+    from alembic.config import Config
+    from sqlalchemy import text
+    from app.data.database import engine
+    with engine.begin() as connection:
+        connection.execute(text("DROP SCHEMA public CASCADE; CREATE SCHEMA public"))
+    command.upgrade(Config("alembic.ini"), "head")
+
+def seed_users(count: int) -> list[int]:
+    """count verified users with the password passw0rd1 and emails user<n>@quore.test, returns their ids"""
+    from sqlalchemy import text
+    from app.auth import hash
+    from app.data.database import engine
+    with engine.begin() as connection:
+        ids = [id for id, in connection.execute(text("""
+            INSERT INTO profiles (name, birth, sex, fcm_token, avatar, images, uploaded, latitude, longitude)
+            SELECT 'user' || i, date '1990-01-01' + i % 5000, CASE WHEN i % 2 = 0 THEN 'm' ELSE 'f' END, 'token' || i, false, '{}', 0,
+                   55 + i % 100 * 0.01, 37 + i % 100 * 0.01
+            FROM generate_series(1, :count) AS i RETURNING id"""), {"count": count})]
+        connection.execute(text("""
+            INSERT INTO auth (id, verified, email, hashed, sent, user_id)
+            SELECT gen_random_uuid(), true, name || '@quore.test', :hashed, now(), id FROM profiles WHERE id = ANY(:ids)"""),
+                           {"hashed": hash.hash("passw0rd1"), "ids": ids})
+        connection.execute(text("ANALYZE"))
+    return sorted(ids)
+
+def percentile(values: list[float], share: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(share * len(ordered)))]
+
+class Timer:
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.seconds = time.perf_counter() - self.started
+
+class MemoryS3:
+    """In-memory stand-in for the calls media and export make on the S3 client"""
+    class exceptions:
+        class BucketAlreadyOwnedByYou(Exception):
+            pass
+
+        class BucketAlreadyExists(Exception):
+            pass
+
+    def __init__(self):
+        self.objects = {}
+        self.uploads = {}
+
+    def create_bucket(self, Bucket):
+        pass
+
+    def upload_fileobj(self, file, bucket, key, ExtraArgs=None):
+        self.objects[(bucket, key)] = file.read()
+
+    def generate_presigned_url(self, operation, Params, ExpiresIn):
+        return f"http://s3:8000/{Params['Bucket']}/{Params['Key']}?expires={ExpiresIn}"
+
+    def delete_objects(self, Bucket, Delete):
+        for item in Delete["Objects"]:
+            self.objects.pop((Bucket, item["Key"]), None)
+        return {}
+
+    def create_multipart_upload(self, Bucket, Key, ContentType=None):
+        self.uploads[Key] = []
+        return {"UploadId": Key}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        self.uploads[UploadId].append(Body)
+        return {"ETag": str(PartNumber)}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        self.objects[(Bucket, Key)] = b"".join(self.uploads.pop(UploadId))
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.uploads.pop(UploadId, None)
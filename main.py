@@ -1,15 +1,18 @@
-from fastapi import FastAPI, status, Depends, BackgroundTasks, Query, Body, File
+from fastapi import FastAPI, status, Depends, BackgroundTasks, Query, Body, File, UploadFile, Request, WebSocket, WebSocketDisconnect
+from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import FileResponse, HTMLResponse, JSONResponse
-import jinja2, datetime
+import datetime
 from sqlalchemy.orm import Session
-from fastapi_mail import FastMail, MessageSchema, MessageType
 from os import environ
 from pathlib import Path
 from app.auth import hash, jwt_handler, jwt_bearer, mail
-from app.data import crud, schemas, media
-from app.data.database import session, engine, base
+from app.data import async_crud as crud, schemas, media, images, purge, export, database, cache
+from app.data.database import session, async_session, DB_ASYNC
 from app.notify import manager
-import re, random, string
+from app.notify.hub import hub
+import re, uuid, asyncio, logging
+
+logger = logging.getLogger(__name__)
 
 tags_metadata = [
     {
@@ -38,8 +41,6 @@ tags_metadata = [
     }
 ]
 
-base.metadata.create_all(engine)
-
 app = FastAPI(title="Quore API",
               description="Only for devs)",
               version="0.9.9",
@@ -50,15 +51,42 @@ app = FastAPI(title="Quore API",
               },
               openapi_tags=tags_metadata,
               root_path='/api')
-mail = FastMail(mail.configuration)
-jinja = jinja2.Environment()
+SWIPES_LIMIT = 500
 
-def get_db():
-    db = session()
-    try:
-        yield db
-    finally:
-        db.close()
+async def get_db():
+    if DB_ASYNC:
+        async with async_session() as db:
+            yield db
+    else:
+        db = session()
+        try:
+            yield db
+        finally:
+            db.close()
+
+@app.on_event("startup")
+async def startup():
+    await run_in_threadpool(media.create_buckets)
+    mail.preload()
+    mail.mailer.start()
+    asyncio.get_running_loop().run_in_executor(None, purge.resume)
+    app.state.export_resume = asyncio.create_task(export.resume())
+    await hub.start()
+    manager.dispatcher.start()
+
+@app.on_event("shutdown")
+async def shutdown():
+    await manager.dispatcher.stop()
+    await mail.mailer.stop()
+    await hub.stop()
+
+@app.exception_handler(hash.Saturated)
+async def hash_saturated(request, exc):
+    return JSONResponse({"error": "server busy"}, status.HTTP_503_SERVICE_UNAVAILABLE, headers={"Retry-After": "1"})
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    return {"hash": hash.stats(), "db": database.stats(), "profile_cache": cache.profiles.stats()}
 
 @app.get("/favicon.ico", include_in_schema=False)
 async def favicon():
@@ -93,14 +121,18 @@ async def login(auth: schemas.AuthCreate, db: Session = Depends(get_db)):
     """
     Авторизация пользователя по почте и паролю. Возвращает JWT-токены для дальнейших запросов
     """
-    if not crud.get_user_by_email(db, auth.email):
+    account = await crud.get_login(db, auth.email)
+    if not account:
         return JSONResponse({"error":"invalid user"}, status.HTTP_401_UNAUTHORIZED)
-    if not hash.verify(auth.password, crud.get_hashed(db, auth.email)):
+    verified, new_hash = await hash.verify_and_update(auth.password, account.hashed)
+    if not verified:
         return JSONResponse({"error":"invalid user"}, status.HTTP_401_UNAUTHORIZED)
-    if not crud.get_email_verified(db, auth.email):
+    if new_hash:
+        await crud.change_hashed(db, auth.email, new_hash)
+    if not account.verified:
         return JSONResponse({"error":"invalid user"}, status.HTTP_401_UNAUTHORIZED)
-    return {"access_token": jwt_handler.access_token(crud.get_id(db, auth.email)),
-            "refresh_token": jwt_handler.refresh_token(crud.get_id(db, auth.email))}
+    return {"access_token": jwt_handler.access_token(account.user_id),
+            "refresh_token": jwt_handler.refresh_token(account.user_id)}
 
 @app.post("/register", status_code=status.HTTP_201_CREATED, tags=["Авторизация"], responses={
     401: {"description": "Пользователь с данной электронной почтой уже существует", "content": {
@@ -129,7 +161,7 @@ async def login(auth: schemas.AuthCreate, db: Session = Depends(get_db)):
         }
     }}
 })
-async def register(background_tasks: BackgroundTasks, profile: schemas.ProfileCreate, auth: schemas.AuthCreate, db: Session = Depends(get_db)):
+async def register(profile: schemas.ProfileCreate, auth: schemas.AuthCreate, db: Session = Depends(get_db)):
     """
     Регистрация пользователя. После регистрации на указанную почту отправляется письмо с ссылкой на подтверждение (см. /verify) 
     Для успешной регистрации поля должны соответствовать следующим требованиям:
@@ -140,28 +172,19 @@ async def register(background_tasks: BackgroundTasks, profile: schemas.ProfileCr
     """
     if not re.match(r"\S+@\S+\.\S+" , auth.email):
         return JSONResponse({"error": "invalid email"}, status.HTTP_400_BAD_REQUEST)
-    if crud.get_user_by_email(db, auth.email):
+    if await crud.get_user_by_email(db, auth.email):
         return JSONResponse({"error": "user exists"}, status.HTTP_401_UNAUTHORIZED)
     if sum(symbol.isdigit() for symbol in auth.password) == 0 or len(auth.password) < 8 or sum(symbol.isalpha() for symbol in auth.password) == 0:
         return JSONResponse({"error": "invalid password"}, status.HTTP_400_BAD_REQUEST)
     if datetime.date.today().year - profile.birth.year - ((datetime.date.today().month, datetime.date.today().day) < (profile.birth.month, profile.birth.day)) < 18:
         return JSONResponse({"error": "adults only"}, status.HTTP_400_BAD_REQUEST)
-    res = crud.create_profile(db, profile)
-    generated_id = ''.join(random.choice(string.ascii_letters + string.digits) for i in range(128))
-    while crud.get_auth(db, generated_id) != None:
-        generated_id = ''.join(random.choice(string.ascii_letters + string.digits) for i in range(128))
-    crud.create_auth(db, auth, res, generated_id)
-    with open('confirm.html', 'r') as file:
-        template = jinja.from_string(file.read().rstrip())
-    message = MessageSchema(
-        subject="Подтверди свою почту",
-        recipients=[auth.email],
-        body=template.render(id=generated_id),
-        subtype=MessageType.html)
+    hashed = await hash.hash_async(auth.password)
+    res = await crud.create_profile(db, profile)
+    token = await crud.create_auth(db, auth, res, hashed)
     if int(environ["DEBUG"]):
-        crud.verify_auth(db, generated_id)
+        await crud.verify_auth(db, token)
     else:
-        background_tasks.add_task(mail.send_message, message)
+        mail.send("Подтверди свою почту", auth.email, "confirm.html", id=token.hex)
     return {"result": "success"}
 
 @app.get("/verify/{id}", tags=["Запросы для пользователей"], response_class=HTMLResponse, responses={
@@ -186,9 +209,13 @@ async def verify(id: str, db: Session = Depends(get_db)):
     Запрос посылается от пользователя при переходе по ссылке из письма (см. /register)
     Возвращает HTML с текстом о статусе подтверждения
     """
-    if crud.get_auth(db, id):
-        if not crud.get_verified(db, id):
-            crud.verify_auth(db, id)
+    try:
+        id = uuid.UUID(id)
+    except ValueError:
+        return HTMLResponse("""Неправильная ссылка или почта не найдена""", status.HTTP_400_BAD_REQUEST)
+    if await crud.get_auth(db, id):
+        if not await crud.get_verified(db, id):
+            await crud.verify_auth(db, id)
             return HTMLResponse("""Электронная почта подтверждена""", status.HTTP_200_OK)
         else:
             return HTMLResponse("""Почта уже была подтверждена""", status.HTTP_410_GONE)
@@ -217,29 +244,19 @@ async def verify(id: str, db: Session = Depends(get_db)):
         }
     }}
 })
-async def resend(background_tasks: BackgroundTasks, email: str, db: Session = Depends(get_db)):
+async def resend(email: str, db: Session = Depends(get_db)):
     """
     Запрос повторной отправки письма на почту. Можно вызвать только раз в 45 секунд.
     """
-    if not crud.get_user_by_email(db, email):
+    account = await crud.get_login(db, email)
+    if not account:
         return JSONResponse({"error": "invalid user"}, status.HTTP_404_NOT_FOUND)
-    if crud.get_email_verified(db, email):
+    if account.verified:
         return JSONResponse({"error": "user verified"}, status.HTTP_400_BAD_REQUEST)
-    if (datetime.datetime.today() - crud.get_email_sent(db, email)).total_seconds() < 45:
+    if (datetime.datetime.today() - account.sent).total_seconds() < 45:
         return JSONResponse({"error": "timeout"}, status.HTTP_425_TOO_EARLY)
-    generated_id = ''.join(random.choice(string.ascii_letters + string.digits) for i in range(128))
-    while crud.get_auth(db, generated_id) != None:
-        generated_id = ''.join(random.choice(string.ascii_letters + string.digits) for i in range(128))
-    crud.change_auth_id(db, email, generated_id)
-    with open('confirm.html', 'r') as file:
-        template = jinja.from_string(file.read().rstrip())
-    message = MessageSchema(
-        subject="Подтверди свою почту",
-        recipients=[email],
-        body=template.render(id=generated_id),
-        subtype=MessageType.html)
-    background_tasks.add_task(mail.send_message, message)
-    crud.change_auth_sent(db, email, datetime.datetime.today())
+    token = await crud.renew_auth(db, email, datetime.datetime.today())
+    mail.send("Подтверди свою почту", email, "confirm.html", id=token.hex)
     return {"result": "success"}
 
 @app.get("/refresh", tags=["Авторизация"], responses={
@@ -250,51 +267,56 @@ async def resend(background_tasks: BackgroundTasks, email: str, db: Session = De
         }
     }}
 })
-async def refresh(token = Depends(jwt_bearer.JWTRefreshBearer())):
+async def refresh(user: jwt_bearer.Principal = Depends(jwt_bearer.JWTRefreshBearer())):
     """
     Обновление access token и refresh token. Требуется авторизация по refresh token через заголовок Authorization: Bearer TOKEN
     """
-    return {"access_token": jwt_handler.access_token(jwt_handler.refresh_decode(token)['id']),
-            "refresh_token": jwt_handler.refresh_token(jwt_handler.refresh_decode(token)['id'])}
+    return {"access_token": jwt_handler.access_token(user.id),
+            "refresh_token": jwt_handler.refresh_token(user.id)}
 
 @app.get("/cards", tags=["Рекомандации"], responses={
-    200: {"description": "Карточки пользователей", "content": {
+    200: {"description": "Страница карточек пользователей и курсор следующей страницы (null на последней странице)", "content": {
         "application/json": {
-            "example": [
-                {
-                    "id": 0,
-                    "name": "Ivan Ivanov",
-                    "age": 18,
-                    "status": "Love cats and FastAPI",
-                    "avatar": None,
-                    "distance": 0.5934234
-                },
-                {
-                    "id": 1,
-                    "name": "Peter Petrov",
-                    "age": 20,
-                    "status": "Never gonna give you up",
-                    "avatar": "https://novatorsmobile.ru/s3/images/1_1.jpg?AWSAccessKeyId=quoreapi&Signature=aG93eW91cmVhZHRoaXM=&Expires=1168335660"
-                }
-            ]
+            "example": {
+                "cards": [
+                    {
+                        "id": 0,
+                        "name": "Ivan Ivanov",
+                        "age": 18,
+                        "status": "Love cats and FastAPI",
+                        "avatar": None,
+                        "distance": 0.5934234
+                    },
+                    {
+                        "id": 1,
+                        "name": "Peter Petrov",
+                        "age": 20,
+                        "status": "Never gonna give you up",
+                        "avatar": "https://novatorsmobile.ru/s3/images/1_1.jpg?AWSAccessKeyId=quoreapi&Signature=aG93eW91cmVhZHRoaXM=&Expires=1168335660"
+                    }
+                ],
+                "cursor": "WzEuMywgMV0"
+            }
+        }
+    }},
+    400: {"description": "Неправильный курсор", "content": {
+        "application/json": {
+            "example": {"error": "invalid cursor"}
         }
     }}
 })
-async def cards(agefrom: int = Query(None, description="Старше"), ageto: int = Query(None, description="Младше"), sex: str = Query(None, description="Пол"), latitude: float = Query(None, description="Широта"), longitude: float = Query(None, description="Долгота"), db: Session = Depends(get_db), token = Depends(jwt_bearer.JWTAccessBearer())):
+async def cards(agefrom: int = Query(None, ge=0, le=150, description="Старше"), ageto: int = Query(None, ge=0, le=150, description="Младше"), sex: str = Query(None, description="Пол"), latitude: float = Query(None, description="Широта"), longitude: float = Query(None, description="Долгота"), radius_km: float = Query(None, gt=0, description="Радиус поиска в километрах"), limit: int = Query(20, ge=1, le=100, description="Количество карточек на странице"), cursor: str = Query(None, description="Курсор следующей страницы из предыдущего ответа"), db: Session = Depends(get_db), user: jwt_bearer.Principal = Depends(jwt_bearer.JWTAccessBearer())):
     """
-    Выдача рекомендации карточек. На данный момент отображаются все пользователи за исключением авторизованного.
+    Выдача рекомендации карточек постранично из заранее подобранных кандидатов, по умолчанию отсортированных по расстоянию до авторизованного пользователя. Пользователи, которым уже поставлен лайк или дизлайк, не отображаются. При указании radius_km отображаются только пользователи в пределах радиуса. Не указанные фильтры берутся из предпочтений профиля.
     """
     if latitude and longitude:
-        crud.set_cords(db, jwt_handler.access_decode(token)['id'], latitude, longitude)
-    if not agefrom:
-        agefrom = 0
-    if not ageto:
-        ageto = 2000
-    if sex:
-        return crud.get_all_profiles_by_sex(db, jwt_handler.access_decode(token)['id'], agefrom, ageto, sex)
-    else:
-        return crud.get_all_profiles(db, jwt_handler.access_decode(token)['id'], agefrom, ageto)
-    
+        await crud.set_cords(db, user.id, latitude, longitude)
+    try:
+        result, next_cursor = await crud.get_cards(db, user.id, agefrom, ageto, sex, radius_km, limit, cursor)
+    except ValueError:
+        return JSONResponse({"error": "invalid cursor"}, status.HTTP_400_BAD_REQUEST)
+    return {"cards": result, "cursor": next_cursor}
+
 @app.get("/like", tags=["Рекомандации"], responses={
     200: {"description": "Лайки от других пользователей", "content": {
         "application/json": {
@@ -311,11 +333,13 @@ async def cards(agefrom: int = Query(None, description="Старше"), ageto: i
         }
     }}
 })
-def get_likes(db: Session = Depends(get_db), token = Depends(jwt_bearer.JWTAccessBearer())):
+async def get_likes(db: Session = Depends(get_db), user: jwt_bearer.Principal = Depends(jwt_bearer.JWTAccessBearer())):
     """
     Лайки авторизованного пользователя. Выводится неправильно, дорабатывается!!!
     """
-    return crud.get_likes(db, jwt_handler.access_decode(token)['id'])
+    likes = await crud.get_likes(db, user.id)
+    await crud.mark_likes_seen(db, user.id)
+    return likes
 
 @app.post("/like", tags=["Рекомандации"], responses={
     200: {"description": "Лайк создан", "content": {
@@ -339,27 +363,21 @@ def get_likes(db: Session = Depends(get_db), token = Depends(jwt_bearer.JWTAcces
         }
     }}
 })
-async def like_profile(id: int = Query(..., description="ID профиля"), db: Session = Depends(get_db), token = Depends(jwt_bearer.JWTAccessBearer())):
+async def like_profile(id: int = Query(..., description="ID профиля"), db: Session = Depends(get_db), user: jwt_bearer.Principal = Depends(jwt_bearer.JWTAccessBearer())):
     """
     Поставить лайк пользователю. Если лайк уже поставлен - лайк удаляется. Если был дизлайк - удаляется дизлайк и ставится лайк. При наличии лайка от другого пользователя сообщает о мэтче.
     """
-    if not crud.get_profile(db, id):
+    if not await crud.profile_exists(db, id):
         return JSONResponse({"error": "user not found"}, status.HTTP_404_NOT_FOUND)
-    initiator = jwt_handler.access_decode(token)['id']
-    if len(crud.get_likes(db, id)) % 5 == 0 and len(crud.get_likes(db, id)) != 0:
-        manager.sendNotification("Ого! Сколько лайков!", "Не забывайте реагировать в ответ",  [crud.get_fcm_token(db, id)])
-    if crud.get_like(db, initiator, id):
-        crud.delete_like(db, initiator, id)
+    result, likes_received = await crud.swipe(db, user.id, id, "like")
+    if result == "deleted":
         return JSONResponse({"result": "deleted"}, status.HTTP_202_ACCEPTED)
-    if crud.get_like(db, id, initiator):
-        crud.match(db, id, initiator)
-        manager.sendNotification("Чувства взаимны!", "У вас новый мэтч, скорее начните общение", [crud.get_fcm_token(db, id)], {"id": str(initiator)})
+    if result == "match":
+        manager.sendNotification("Чувства взаимны!", "У вас новый мэтч, скорее начните общение", [await crud.get_fcm_token(db, id)], {"id": str(user.id)})
         return JSONResponse({"result": "match"}, status.HTTP_200_OK)
-    else:
-        if crud.get_dislike(db, initiator, id):
-            crud.delete_dislike(db, initiator, id)
-        crud.like(db, initiator, id)
-        return JSONResponse({"result": "liked"}, status.HTTP_201_CREATED)
+    if likes_received and likes_received % 5 == 0:
+        manager.sendNotification("Ого! Сколько лайков!", "Не забывайте реагировать в ответ",  [await crud.get_fcm_token(db, id)])
+    return JSONResponse({"result": "liked"}, status.HTTP_201_CREATED)
 
 @app.post("/dislike", tags=["Рекомандации"], responses={
     201: {"description": "Дизлайк создан", "content": {
@@ -378,33 +396,72 @@ async def like_profile(id: int = Query(..., description="ID профиля"), db
         }
     }}
 })
-async def dislike_profile(id: int = Query(..., description="ID профиля"), db: Session = Depends(get_db), token = Depends(jwt_bearer.JWTAccessBearer())):
+async def dislike_profile(id: int = Query(..., description="ID профиля"), db: Session = Depends(get_db), user: jwt_bearer.Principal = Depends(jwt_bearer.JWTAccessBearer())):
     """
     Поставить профилю дизлайк. Если был лайк - удаляется лайк и ставится дизлайк. Если дизлайк уже поставлен - дизлайк удаляется.
     """
-    if not crud.get_profile(db, id):
+    if not await crud.profile_exists(db, id):
         return JSONResponse({"error": "user not found"}, status.HTTP_404_NOT_FOUND)
-    if crud.get_dislike(db, jwt_handler.access_decode(token)['id'], id):
-        crud.delete_dislike(db, jwt_handler.access_decode(token)['id'], id)
+    result, _ = await crud.swipe(db, user.id, id, "dislike")
+    if result == "deleted":
         return JSONResponse({"result": "deleted"}, status.HTTP_202_ACCEPTED)
-    if crud.get_like(db, jwt_handler.access_decode(token)['id'], id):
-        crud.delete_like(db, jwt_handler.access_decode(token)['id'], id)
-    crud.dislike(db, jwt_handler.access_decode(token)['id'], id)
     return JSONResponse({"result": "disliked"}, status.HTTP_201_CREATED)
 
-@app.post("/images", tags=["Галерея"], responses={
+@app.post("/swipes", tags=["Рекомандации"], responses={
+    200: {"description": "Решения применены. Возвращает ID пользователей, с которыми есть мэтч", "content": {
+        "application/json": {
+            "example": {"matches": [4, 8]}
+        }
+    }},
+    422: {"description": "Слишком много решений в одном запросе или неверный формат решения"}
+})
+async def post_swipes(swipes: list[schemas.Swipe] = Body(..., max_length=SWIPES_LIMIT), db: Session = Depends(get_db), user: jwt_bearer.Principal = Depends(jwt_bearer.JWTAccessBearer())):
+    """
+    Пакетная отправка лайков и дизлайков, накопленных приложением, одним запросом (не больше 500).
+    В отличие от /like и /dislike повторное решение не снимает реакцию. При нескольких решениях по одному пользователю применяется последнее, несуществующие пользователи пропускаются.
+    """
+    matches, new_matches, likes_received = await crud.swipes(db, user.id, {swipe.target: swipe.action for swipe in swipes})
+    milestones = [target for target, count in likes_received.items() if count % 5 == 0]
+    if new_matches or milestones:
+        tokens = await crud.get_fcm_tokens(db, new_matches + milestones)
+        for target in new_matches:
+            manager.sendNotification("Чувства взаимны!", "У вас новый мэтч, скорее начните общение", [tokens.get(target)], {"id": str(user.id)})
+        if milestones:
+            manager.sendNotification("Ого! Сколько лайков!", "Не забывайте реагировать в ответ", [tokens.get(target) for target in milestones])
+    return {"matches": matches}
+
+def raw_body(description: str):
+    """OpenAPI description of a body read from request.stream() instead of a Body parameter"""
+    return {"requestBody": {"description": description, "content": {"image/*": {"schema": {"type": "string", "format": "binary"}}}}}
+
+@app.post("/images", tags=["Галерея"], openapi_extra=raw_body("Изображение"), responses={
     200: {"description": "Изображение успешно загружен", "content": {
         "application/json": {
             "example": {"result": "success"}
         }
+    }},
+    400: {"description": "Файл не является изображением", "content": {
+        "application/json": {
+            "example": {"error": "invalid image"}
+        }
     }}
 })
-async def post_image(image: bytes = Body(None, description="Изображение", media_type="image/*"), db: Session = Depends(get_db), token = Depends(jwt_bearer.JWTAccessBearer())):
-    """
-    Загрузить изображение в публичный доступ
-    """
-    id = jwt_handler.access_decode(token)['id']
-    media.upload_image(image, id, crud.add_image(db, id))
+async def post_image(request: Request, background_tasks: BackgroundTasks, db: Session = Depends(get_db), user: jwt_bearer.Principal = Depends(jwt_bearer.JWTAccessBearer())):
+    """
+    Загрузить изображение в публичный доступ. Изображение обрабатывается после ответа, миниатюры появляются с небольшой задержкой
+    """
+    id = user.id
+    image = await media.spool(request.stream())
+    if image:
+        try:
+            await run_in_threadpool(images.validate, image)
+        except images.InvalidImage:
+            image.close()
+            return JSONResponse({"error": "invalid image"}, status.HTTP_400_BAD_REQUEST)
+        # Background tasks run in order, a failed upload never reaches the gallery
+        count = await crud.reserve_image(db, id)
+        background_tasks.add_task(media.upload_image, image, id, count)
+        background_tasks.add_task(crud.add_image, db, id, count)
     return {"result": "success"}
 
 @app.get("/images", tags=["Галерея"], responses={
@@ -423,16 +480,16 @@ async def post_image(image: bytes = Body(None, description="Изображени
         }
     }}
 })
-async def get_images(id: int = Query(None, description="ID профиля. При отсутствии параметра возвращается информация об авторизованном пользователе"), db: Session = Depends(get_db), token = Depends(jwt_bearer.JWTAccessBearer())):
+async def get_images(id: int = Query(None, description="ID профиля. При отсутствии параметра возвращается информация об авторизованном пользователе"), db: Session = Depends(get_db), user: jwt_bearer.Principal = Depends(jwt_bearer.JWTAccessBearer())):
     """
-    Выдача всех изображений, выложенным пользователем в публичный доступ
+    Выдача миниатюр всех изображений, выложенным пользователем в публичный доступ. Полный размер доступен по тому же адресу без префикса thumb/, размер для карточек — с префиксом card/
     """
     if id == None:
-        id = jwt_handler.access_decode(token)['id']
-    result = crud.get_profile(db, id)
+        id = user.id
+    result = await crud.get_profile(db, id)
     if not result:
         return JSONResponse({"error": "user not found"}, status.HTTP_404_NOT_FOUND)
-    return media.get_images(crud.get_images(db, id))
+    return media.get_images(await crud.get_images(db, id), "thumb")
 
 @app.delete("/images", tags=["Галерея"], responses={
     200: {"description": "Удаление изображения", "content": {
@@ -446,14 +503,14 @@ async def get_images(id: int = Query(None, description="ID профиля. Пр
         }
     }}
 })
-async def delete_image(file: str = Query(..., description="Имя файла"), db: Session = Depends(get_db), token = Depends(jwt_bearer.JWTAccessBearer())):
+async def delete_image(file: str = Query(..., description="Имя файла"), db: Session = Depends(get_db), user: jwt_bearer.Principal = Depends(jwt_bearer.JWTAccessBearer())):
     """
     Удаление конкретного изображения
     """
-    id = jwt_handler.access_decode(token)['id']
-    if file in crud.get_images(db, id):
-        media.delete_image(file)
-        crud.delete_image(db, id, file)
+    id = user.id
+    if file in await crud.get_images(db, id):
+        await run_in_threadpool(media.delete_image, file)
+        await crud.delete_image(db, id, file)
         return {"result": "success"}
     else:
         return JSONResponse({"error": "no access"}, status.HTTP_403_FORBIDDEN)
@@ -469,7 +526,7 @@ async def delete_image(file: str = Query(..., description="Имя файла"),
             "example": {"error": "user not found"}
         }
     }},
-    400: {"description": "Сообщение не может быть пустым", "content": {
+    400: {"description": "Сообщение не может быть пустым или вложение не является изображением", "content": {
         "application/json": {
             "example": {"error": "message cant be empty"}
         }
@@ -480,23 +537,34 @@ async def delete_image(file: str = Query(..., description="Имя файла"),
         }
     }}
 })
-async def send_message(message: str = Query(None, description="Текст сообщения"), files: list[bytes] = File(None), id: int = Query(..., description="ID получателя"), db: Session = Depends(get_db), token = Depends(jwt_bearer.JWTAccessBearer())):
-    if id == jwt_handler.access_decode(token)['id']:
+async def send_message(message: str = Query(None, description="Текст сообщения"), files: list[UploadFile] = File(None), id: int = Query(..., description="ID получателя"), db: Session = Depends(get_db), user: jwt_bearer.Principal = Depends(jwt_bearer.JWTAccessBearer())):
+    if id == user.id:
         return JSONResponse({"error": "sender cant be recipient"}, status.HTTP_409_CONFLICT)
-    if not crud.get_profile(db, id):
+    if not await crud.profile_exists(db, id):
         return JSONResponse({"error": "user not found"}, status.HTTP_404_NOT_FOUND)
-    if message or files:
-        message_object = crud.write_message(db, jwt_handler.access_decode(token)['id'], id, message)
-    else:
+    if not message and not files:
         return JSONResponse({"error": "message cant be empty"}, status.HTTP_400_BAD_REQUEST)
+    try:
+        for file in files or []:
+            await run_in_threadpool(images.validate, file.file)
+    except images.InvalidImage:
+        return JSONResponse({"error": "invalid image"}, status.HTTP_400_BAD_REQUEST)
+    message_object = await crud.write_message(db, user.id, id, message)
+    event = {"id": message_object.id, "sender": message_object.sender, "recipient": message_object.recipient, "sent": message_object.sent, "message": message_object.message, "attachments": None}
     if files:
-        filenames = media.upload_chat(files, message_object.id)
-        crud.add_files_to_message(db, message_object.id, filenames)
-    manager.sendNotification("Новое сообщение", "От пользователя " + crud.get_profile_name(db, id), [crud.get_fcm_token(db, id)])
+        filenames = await run_in_threadpool(media.upload_chat, [file.file for file in files], message_object.id)
+        await crud.add_files_to_message(db, message_object.id, filenames)
+        event["attachments"] = media.get_chat(filenames)
+    try:
+        await hub.publish(id, event)
+    except Exception:
+        # The message is stored, open clients get it through GET /chat and the push below still goes out
+        logger.exception("Publishing message %d failed", message_object.id)
+    manager.sendNotification("Новое сообщение", "От пользователя " + await crud.get_profile_name(db, user.id), [await crud.get_fcm_token(db, id)])
     return {"result": "success"}
 
 @app.get("/chat", tags=["Чат"], responses={
-    200: {"description": "Все сообщения из чата", "content": {
+    200: {"description": "Страница сообщений из чата", "content": {
         "application/json": {
             "example": [
                 {
@@ -537,12 +605,35 @@ async def send_message(message: str = Query(None, description="Текст соо
         }
     }}
 })
-async def get_messages(id: int = Query(..., description="ID получателя"), db: Session = Depends(get_db), token = Depends(jwt_bearer.JWTAccessBearer())):
-    if id == jwt_handler.access_decode(token)['id']:
+async def get_messages(id: int = Query(..., description="ID получателя"), before: int = Query(None, description="Вернуть сообщения, отправленные до сообщения с этим ID"), after: int = Query(None, description="Вернуть сообщения, отправленные после сообщения с этим ID"), limit: int = Query(50, ge=1, le=100, description="Количество сообщений"), db: Session = Depends(get_db), user: jwt_bearer.Principal = Depends(jwt_bearer.JWTAccessBearer())):
+    """
+    Сообщения из чата в хронологическом порядке, не больше limit. Без before и after возвращаются последние сообщения
+    """
+    if id == user.id:
         return JSONResponse({"error": "sender cant be recipient"}, status.HTTP_409_CONFLICT)
-    if not crud.get_profile(db, id):
+    if not await crud.get_profile(db, id):
         return JSONResponse({"error": "user not found"}, status.HTTP_404_NOT_FOUND)
-    return crud.get_messages(db, jwt_handler.access_decode(token)['id'], id)
+    return await crud.get_messages(db, user.id, id, before, after, limit)
+
+@app.websocket("/ws/chat")
+async def chat_socket(websocket: WebSocket):
+    """
+    Новые сообщения в реальном времени. Токен передается через заголовок Authorization: Bearer TOKEN или параметр token.
+    Каждое входящее сообщение приходит в формате элемента из GET /chat
+    """
+    user = jwt_bearer.websocket_principal(websocket)
+    if not user:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    await websocket.accept()
+    hub.connect(user.id, websocket)
+    try:
+        while True:
+            await websocket.receive_text()
+    except WebSocketDisconnect:
+        pass
+    finally:
+        hub.disconnect(user.id, websocket)
 
 @app.get("/profile", tags=["Управление профилем"], responses={
     200: {"description": "Информация о профиле", "content": {
@@ -563,38 +654,52 @@ async def get_messages(id: int = Query(..., description="ID получателя
         }
     }}
 })
-async def profile_get(id: int = Query(None, description="ID профиля. При отсутствии параметра возвращается информация об авторизованном пользователе"), db: Session = Depends(get_db), token = Depends(jwt_bearer.JWTAccessBearer())):
+async def profile_get(id: int = Query(None, description="ID профиля. При отсутствии параметра возвращается информация об авторизованном пользователе"), db: Session = Depends(get_db), user: jwt_bearer.Principal = Depends(jwt_bearer.JWTAccessBearer())):
     """
     Полная информация о профиле
     """
     if id == None:
-        id = jwt_handler.access_decode(token)['id']
-    result = crud.get_profile(db, id)
+        id = user.id
+    result = await crud.get_profile(db, id)
     if not result:
         return JSONResponse({"error": "user not found"}, status.HTTP_404_NOT_FOUND)
     return result
 
-@app.patch("/profile", tags=["Управление профилем"], responses={
+@app.patch("/profile", tags=["Управление профилем"], openapi_extra=raw_body("Аватар"), responses={
     200: {"description": "Информация обновлена", "content": {
         "application/json": {
             "example": {"result": "success"}
         }
+    }},
+    400: {"description": "Аватар не является изображением", "content": {
+        "application/json": {
+            "example": {"error": "invalid image"}
+        }
     }}
 })
-async def profile_edit(name: str = Query(None, description="Имя пользователя"), status: str = Query(None, description="Отображаемый статус"), about: str = Query(None, description="О себе"), avatar: bytes = Body(None, description="Аватар"), db: Session = Depends(get_db), token = Depends(jwt_bearer.JWTAccessBearer())):
+async def profile_edit(request: Request, background_tasks: BackgroundTasks, name: str = Query(None, description="Имя пользователя"), status: str = Query(None, description="Отображаемый статус"), about: str = Query(None, description="О себе"), db: Session = Depends(get_db), user: jwt_bearer.Principal = Depends(jwt_bearer.JWTAccessBearer())):
     """
     Изменение информации профиля авторизованного пользователя
     """
-    id = jwt_handler.access_decode(token)['id']
+    id = user.id
+    avatar = await media.spool(request.stream())
+    if avatar != None:
+        try:
+            await run_in_threadpool(images.validate, avatar)
+        except images.InvalidImage:
+            avatar.close()
+            # status is shadowed by the query parameter here
+            return JSONResponse({"error": "invalid image"}, 400)
     if name != None:
-        crud.change_name(db, id, name)
+        await crud.change_name(db, id, name)
     if status != None:
-        crud.change_status(db, id, status)
+        await crud.change_status(db, id, status)
     if about != None:
-        crud.change_about(db, id, about)
+        await crud.change_about(db, id, about)
     if avatar != None:
-        crud.create_avatar(db, id)
-        media.upload_avatar(avatar, id)
+        # Background tasks run in order, the avatar is switched to once it is uploaded
+        background_tasks.add_task(media.upload_avatar, avatar, id)
+        background_tasks.add_task(crud.create_avatar, db, id)
     return {"result": "success"}
 
 @app.delete("/profile", tags=["Управление профилем"], responses={
@@ -609,24 +714,43 @@ async def profile_edit(name: str = Query(None, description="Имя пользо
         }
     }},
 })
-async def profile_delete(password: str = Query(..., description="Пароль пользователя"), db: Session = Depends(get_db), token = Depends(jwt_bearer.JWTAccessBearer())):
+async def profile_delete(background_tasks: BackgroundTasks, password: str = Query(..., description="Пароль пользователя"), db: Session = Depends(get_db), user: jwt_bearer.Principal = Depends(jwt_bearer.JWTAccessBearer())):
     """
-    Удаление профиля и другой связанной информации
+    Удаление профиля и другой связанной информации. Профиль, переписка и реакции удаляются сразу, файлы удаляются в фоне, прогресс доступен через GET /profile/purge
     """
-    id = jwt_handler.access_decode(token)['id']
-    auth = crud.get_auth_profile(db, jwt_handler.access_decode(token)['id'])
+    id = user.id
+    auth = await crud.get_auth_profile(db, user.id)
     if auth:
-        if not hash.verify(password, auth.hashed):
+        if not await hash.verify_async(password, auth.hashed):
             return JSONResponse({"error": "not verified"}, status.HTTP_401_UNAUTHORIZED)
     else:
         return JSONResponse({"error": "not verified"}, status.HTTP_401_UNAUTHORIZED)
-    media.delete_all_images(crud.get_images(db, id))
-    media.delete_avatar(id)
-    crud.delete_user(db, id)
+    background_tasks.add_task(purge.run, await crud.delete_user(db, id))
     return JSONResponse({"result": "success"}, status.HTTP_200_OK)
 
+@app.get("/profile/purge", tags=["Управление профилем"], responses={
+    200: {"description": "Прогресс удаления файлов профиля", "content": {
+        "application/json": {
+            "example": {"total": 42, "done": 42, "finished": "2024-01-01T02:00:00.000000"}
+        }
+    }},
+    404: {"description": "Профиль не удалялся", "content": {
+        "application/json": {
+            "example": {"error": "job not found"}
+        }
+    }}
+})
+async def profile_purge(db: Session = Depends(get_db), user: jwt_bearer.Principal = Depends(jwt_bearer.JWTAccessBearer())):
+    """
+    Прогресс удаления файлов после удаления профиля. Доступно по токену удаленного профиля, пока он действителен
+    """
+    job = await crud.get_purge_job(db, user.id)
+    if not job:
+        return JSONResponse({"error": "job not found"}, status.HTTP_404_NOT_FOUND)
+    return {"total": len(job.objects), "done": job.done, "finished": job.finished}
+
 @app.get("/gdpr", tags=["Управление профилем"], responses={
-    200: {"description": "Информация отправленна на электронную почту", "content": {
+    200: {"description": "Выгрузка запущена, ссылка на архив будет отправлена на электронную почту", "content": {
         "application/json": {
             "example": {"result": "success"}
         }
@@ -637,30 +761,36 @@ async def profile_delete(password: str = Query(..., description="Пароль п
         }
     }},
 })
-async def gdpr_request(background_tasks: BackgroundTasks, password: str = Query(..., description="Пароль пользователя"), db: Session = Depends(get_db), token = Depends(jwt_bearer.JWTAccessBearer())):
+async def gdpr_request(background_tasks: BackgroundTasks, password: str = Query(..., description="Пароль пользователя"), db: Session = Depends(get_db), user: jwt_bearer.Principal = Depends(jwt_bearer.JWTAccessBearer())):
     """
-    Запрос информации о пользователе. Требуется в соответствии с федеральным законом №152-ФЗ "О персональных данных" Российской федерации и Общим регламентом защиты персональных данных (GDPR) Европейского союза
+    Запрос информации о пользователе. Требуется в соответствии с федеральным законом №152-ФЗ "О персональных данных" Российской федерации и Общим регламентом защиты персональных данных (GDPR) Европейского союза. Архив собирается в фоне, статус доступен через GET /gdpr/status
     """
-    auth = crud.get_auth_profile(db, jwt_handler.access_decode(token)['id'])
-    profile = crud.get_full_profile(db, jwt_handler.access_decode(token)['id'])
+    auth = await crud.get_auth_profile(db, user.id)
     if auth:
-        if not hash.verify(password, auth.hashed):
+        if not await hash.verify_async(password, auth.hashed):
             return JSONResponse({"error": "not verified"}, status.HTTP_401_UNAUTHORIZED)
     else:
         return JSONResponse({"error": "not verified"}, status.HTTP_401_UNAUTHORIZED)
-    with open('gdpr.html', 'r') as file:
-        template = jinja.from_string(file.read().rstrip())
-    likes = crud.get_all_likes_name_users(db, jwt_handler.access_decode(token)['id'])
-    dislikes = crud.get_all_dislikes_name_users(db, jwt_handler.access_decode(token)['id'])
-    messages = crud.get_all_messages(db, jwt_handler.access_decode(token)['id'])
-    if profile.avatar:
-        avatar = str(profile.id) + '.png'
-    else:
-        avatar = None
-    message = MessageSchema(
-        subject="Ваш запрос на получение информации",
-        recipients=[auth.email],
-        body=template.render(name=profile.name, birth=profile.birth, age=profile.age, sex=profile.sex, about=profile.about, status=profile.status, email=auth.email, sent=auth.sent, likes=likes, dislikes=dislikes, messages=messages, preferences=profile.preferences, avatar=avatar),
-        subtype=MessageType.html)
-    background_tasks.add_task(mail.send_message, message)
-    return JSONResponse({"result": "success"}, status.HTTP_200_OK)
\ No newline at end of file
+    background_tasks.add_task(export.run, await crud.create_export_job(db, user.id, auth.email))
+    return JSONResponse({"result": "success"}, status.HTTP_200_OK)
+
+@app.get("/gdpr/status", tags=["Управление профилем"], responses={
+    200: {"description": "Статус последней выгрузки: pending, running, done или failed. rows - количество выгруженных записей", "content": {
+        "application/json": {
+            "example": {"status": "running", "rows": 12000, "created": "2024-01-01T02:00:00.000000", "finished": None}
+        }
+    }},
+    404: {"description": "Выгрузка не запрашивалась", "content": {
+        "application/json": {
+            "example": {"error": "job not found"}
+        }
+    }}
+})
+async def gdpr_status(db: Session = Depends(get_db), user: jwt_bearer.Principal = Depends(jwt_bearer.JWTAccessBearer())):
+    """
+    Статус последнего запроса информации о пользователе
+    """
+    job = await crud.get_export_job(db, user.id)
+    if not job:
+        return JSONResponse({"error": "job not found"}, status.HTTP_404_NOT_FOUND)
+    return {"status": job.status, "rows": job.rows, "created": job.created, "finished": job.finished}
\ No newline at end of file
@@ -0,0 +1,34 @@
+from logging.config import fileConfig
+from sqlalchemy import create_engine, pool
+from alembic import context
+from os import environ
+from app.data import models
+from app.data.database import base
+
+config = context.config
+if config.config_file_name is not None:
+    fileConfig(config.config_file_name)
+target_metadata = base.metadata
+
+def include_object(object, name, type_, reflected, compare_to):
+    # unique=True next to primary_key=True creates no separate constraint in Postgres, autogenerate would keep adding one
+    return not (type_ == "unique_constraint" and not reflected and set(object.columns) == set(object.table.primary_key.columns))
+
+def run_migrations_offline():
+    """alembic upgrade head --sql, prints the SQL instead of running it"""
+    context.configure(url=environ["DB_SERVER"], target_metadata=target_metadata, include_object=include_object,
+                      literal_binds=True, dialect_opts={"paramstyle": "named"})
+    with context.begin_transaction():
+        context.run_migrations()
+
+def run_migrations_online():
+    engine = create_engine(environ["DB_SERVER"], poolclass=pool.NullPool)
+    with engine.connect() as connection:
+        context.configure(connection=connection, target_metadata=target_metadata, include_object=include_object)
+        with context.begin_transaction():
+            context.run_migrations()
+
+if context.is_offline_mode():
+    run_migrations_offline()
+else:
+    run_migrations_online()
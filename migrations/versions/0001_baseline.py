@@ -0,0 +1,60 @@
+"""
+Baseline schema, the tables main.py used to create with base.metadata.create_all.
+Tables that already exist are left alone, so a database created that way is adopted as is
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0001"
+down_revision = None
+branch_labels = None
+depends_on = None
+
+def create_table(name: str, *columns):
+    if not sa.inspect(op.get_bind()).has_table(name):
+        op.create_table(name, *columns)
+
+def upgrade():
+    create_table("profiles",
+        sa.Column("id", sa.Integer(), primary_key=True, unique=True, autoincrement=True),
+        sa.Column("name", sa.String(50), nullable=False),
+        sa.Column("birth", sa.Date(), nullable=False),
+        sa.Column("sex", sa.String(), nullable=False),
+        sa.Column("about", sa.String(), nullable=True),
+        sa.Column("status", sa.String(), nullable=True),
+        sa.Column("avatar", sa.Boolean()),
+        sa.Column("images", sa.ARRAY(sa.String())),
+        sa.Column("uploaded", sa.Integer(), nullable=True),
+        sa.Column("preferences", sa.String(), nullable=True),
+        sa.Column("latitude", sa.Float(), nullable=True),
+        sa.Column("longitude", sa.Float(), nullable=True),
+        sa.Column("fcm_token", sa.String(), nullable=False))
+    create_table("auth",
+        sa.Column("id", sa.String(), primary_key=True, unique=True),
+        sa.Column("verified", sa.Boolean(), nullable=False),
+        sa.Column("email", sa.String(), sa.CheckConstraint("email LIKE '%@%.%'"), nullable=False, unique=True),
+        sa.Column("hashed", sa.String(), nullable=False),
+        sa.Column("sent", sa.DateTime(), nullable=False),
+        sa.Column("user_id", sa.Integer(), sa.ForeignKey("profiles.id")))
+    create_table("likes",
+        sa.Column("id", sa.Integer(), primary_key=True, unique=True, autoincrement=True),
+        sa.Column("initiator", sa.Integer(), sa.ForeignKey("profiles.id")),
+        sa.Column("target", sa.Integer(), sa.ForeignKey("profiles.id")),
+        sa.Column("match", sa.Boolean()),
+        sa.Column("created", sa.DateTime(), nullable=False))
+    create_table("dislikes",
+        sa.Column("id", sa.Integer(), primary_key=True, unique=True, autoincrement=True),
+        sa.Column("initiator", sa.Integer(), sa.ForeignKey("profiles.id")),
+        sa.Column("target", sa.Integer(), sa.ForeignKey("profiles.id")),
+        sa.Column("created", sa.DateTime(), nullable=False))
+    create_table("messages",
+        sa.Column("id", sa.Integer(), primary_key=True, unique=True, autoincrement=True),
+        sa.Column("sender", sa.Integer(), sa.ForeignKey("profiles.id")),
+        sa.Column("recipient", sa.Integer(), sa.ForeignKey("profiles.id")),
+        sa.Column("sent", sa.DateTime(), nullable=False),
+        sa.Column("message", sa.String(), nullable=True),
+        sa.Column("attachments", sa.ARRAY(sa.String())))
+
+def downgrade():
+    for table in ("messages", "dislikes", "likes", "auth", "profiles"):
+        op.drop_table(table)
@@ -0,0 +1,92 @@
+"""
+Like counters on profiles, unique like and dislike pairs, candidate pools, purge and export jobs, uuid verification
+tokens and the indexes the crud queries run on. Every step checks what is there first, so a database that create_all
+took part of the way is completed rather than failing
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0002"
+down_revision = "0001"
+branch_labels = None
+depends_on = None
+
+COUNTERS = ("likes_received", "unseen_likes", "matches")
+# name, table, columns, unique
+INDEXES = (
+    ("ix_profiles_cords", "profiles", ["latitude", "longitude"], False),
+    ("ix_profiles_sex_birth", "profiles", ["sex", "birth"], False),
+    ("ix_profiles_fcm_token", "profiles", ["fcm_token"], False),
+    ("ix_auth_user", "auth", ["user_id"], False),
+    ("ux_likes_pair", "likes", ["initiator", "target"], True),
+    ("ix_likes_target", "likes", ["target", "initiator"], False),
+    ("ux_dislikes_pair", "dislikes", ["initiator", "target"], True),
+    ("ix_dislikes_target", "dislikes", ["target"], False),
+    ("ix_messages_conversation", "messages", [sa.text("least(sender, recipient)"), sa.text("greatest(sender, recipient)"), "id"], False),
+    ("ix_messages_sender", "messages", ["sender", "recipient"], False),
+    ("ix_messages_recipient", "messages", ["recipient", "sender"], False),
+    ("ix_candidates_rank", "candidates", ["user_id", "score", "candidate_id"], False),
+    ("ix_candidates_candidate", "candidates", ["candidate_id"], False),
+    ("ix_purge_jobs_user", "purge_jobs", ["user_id"], False),
+    ("ix_export_jobs_user", "export_jobs", ["user_id"], False),
+)
+
+def create_table(name: str, *columns):
+    if not sa.inspect(op.get_bind()).has_table(name):
+        op.create_table(name, *columns)
+
+def upgrade():
+    for column in COUNTERS:
+        op.execute(f"ALTER TABLE profiles ADD COLUMN IF NOT EXISTS {column} integer NOT NULL DEFAULT 0")
+    # The unique pair indexes cannot be built over duplicates, the oldest row of each pair is kept
+    for table in ("likes", "dislikes"):
+        op.execute(f"DELETE FROM {table} AS duplicate USING {table} AS kept "
+                   "WHERE duplicate.initiator = kept.initiator AND duplicate.target = kept.target AND duplicate.id > kept.id")
+    create_table("candidate_pools",
+        sa.Column("user_id", sa.Integer(), sa.ForeignKey("profiles.id"), primary_key=True),
+        sa.Column("filters", sa.String(), nullable=False),
+        sa.Column("size", sa.Integer(), nullable=False),
+        sa.Column("built", sa.DateTime(), nullable=False))
+    create_table("candidates",
+        sa.Column("user_id", sa.Integer(), sa.ForeignKey("profiles.id"), primary_key=True),
+        sa.Column("candidate_id", sa.Integer(), sa.ForeignKey("profiles.id"), primary_key=True),
+        sa.Column("score", sa.Float(), nullable=False),
+        sa.Column("distance", sa.Float(), nullable=True))
+    create_table("purge_jobs",
+        sa.Column("id", sa.Integer(), primary_key=True, unique=True, autoincrement=True),
+        sa.Column("user_id", sa.Integer(), nullable=False),
+        sa.Column("objects", sa.ARRAY(sa.String()), nullable=False),
+        sa.Column("done", sa.Integer(), nullable=False),
+        sa.Column("created", sa.DateTime(), nullable=False),
+        sa.Column("finished", sa.DateTime(), nullable=True))
+    create_table("export_jobs",
+        sa.Column("id", sa.Integer(), primary_key=True, unique=True, autoincrement=True),
+        sa.Column("user_id", sa.Integer(), nullable=False),
+        sa.Column("email", sa.String(), nullable=False),
+        sa.Column("status", sa.String(), nullable=False),
+        sa.Column("rows", sa.Integer(), nullable=False),
+        sa.Column("key", sa.String(), nullable=True),
+        sa.Column("error", sa.String(), nullable=True),
+        sa.Column("created", sa.DateTime(), nullable=False),
+        sa.Column("updated", sa.DateTime(), nullable=False),
+        sa.Column("finished", sa.DateTime(), nullable=True))
+    # Outstanding verification links stop working, /resend sends a new one
+    types = {column["name"]: column["type"] for column in sa.inspect(op.get_bind()).get_columns("auth")}
+    if not isinstance(types["id"], sa.Uuid):
+        op.execute("ALTER TABLE auth ALTER COLUMN id TYPE uuid USING gen_random_uuid()")
+    for name, table, columns, unique in INDEXES:
+        op.create_index(name, table, columns, unique=unique, if_not_exists=True)
+    # Same as crud.reconcile_counters
+    op.execute("UPDATE profiles SET likes_received = received.count, unseen_likes = least(unseen_likes, received.count), "
+               "matches = (SELECT count(*) FROM likes WHERE likes.match AND (likes.initiator = profiles.id OR likes.target = profiles.id)) "
+               "FROM (SELECT profiles.id, count(likes.id) AS count FROM profiles LEFT JOIN likes ON likes.target = profiles.id GROUP BY profiles.id) AS received "
+               "WHERE received.id = profiles.id")
+
+def downgrade():
+    for name, table, _, _ in reversed(INDEXES):
+        op.drop_index(name, table, if_exists=True)
+    op.execute("ALTER TABLE auth ALTER COLUMN id TYPE varchar USING replace(id::text, '-', '')")
+    for table in ("export_jobs", "purge_jobs", "candidates", "candidate_pools"):
+        op.drop_table(table)
+    for column in COUNTERS:
+        op.drop_column("profiles", column)
@@ -0,0 +1,15 @@
+"""
+Version of the avatar of every profile, bumped by crud.create_avatar so signed avatar URLs change with the image
+"""
+from alembic import op
+
+revision = "0003"
+down_revision = "0002"
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    op.execute("ALTER TABLE profiles ADD COLUMN IF NOT EXISTS avatar_version integer NOT NULL DEFAULT 0")
+
+def downgrade():
+    op.drop_column("profiles", "avatar_version")
@@ -0,0 +1,3 @@
+#! /usr/bin/env bash
+# Run by the uvicorn-gunicorn-fastapi image before the server starts
+alembic upgrade head
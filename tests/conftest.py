@@ -0,0 +1,65 @@
+"""
+The tests run the app against a Postgres database given by TEST_DB_SERVER, its public schema is dropped and
+migrated from scratch. Without TEST_DB_SERVER every test is skipped. Mail and push notifications use the fake transports
+"""
+from os import environ
+import pytest
+
+TEST_DB_SERVER = environ.get("TEST_DB_SERVER")
+if TEST_DB_SERVER:
+    environ["DB_SERVER"] = TEST_DB_SERVER
+    for name in ("S3_SECRET", "JWT_ACCESS_SECRET", "JWT_REFRESH_SECRET", "MAIL_USERNAME", "MAIL_PASSWORD", "MAIL_SERVER"):
+        environ.setdefault(name, "test")
+    environ.setdefault("MAIL_FROM", "test@quore.test")
+    # Registration verifies the email right away
+    environ["DEBUG"] = "1"
+    environ["MAIL_TRANSPORT"] = "fake"
+    environ["FCM_TRANSPORT"] = "fake"
+    environ["CHAT_BACKEND"] = "memory"
+
+def pytest_collection_modifyitems(config, items):
+    if not TEST_DB_SERVER:
+        skip = pytest.mark.skip(reason="TEST_DB_SERVER is not set")
+        for item in items:
+            item.add_marker(skip)
+
+@pytest.fixture(scope="session")
+def engine():
+    from alembic import command
+    from alembic.config import Config
+    from sqlalchemy import text
+    from app.data.database import engine
+    with engine.begin() as connection:
+        connection.execute(text("DROP SCHEMA public CASCADE; CREATE SCHEMA public"))
+    command.upgrade(Config("alembic.ini"), "head")
+    return engine
+
+@pytest.fixture(scope="session")
+def client(engine):
+    from fastapi.testclient import TestClient
+    import main
+    with TestClient(main.app) as client:
+        yield client
+
+@pytest.fixture(scope="session")
+def register(client):
+    """Registers and logs in a user, returns the authorization headers"""
+    def register(email: str, name: str, sex: str = "m", password: str = "passw0rd1") -> dict:
+        response = client.post("/register", json={"profile": {"name": name, "birth": "2000-01-01", "sex": sex, "fcm_token": "token-" + name},
+                                                  "auth": {"email": email, "password": password}})
+        assert response.status_code == 201, response.text
+        response = client.post("/login", json={"email": email, "password": password})
+        assert response.status_code == 200, response.text
+        return {"Authorization": "Bearer " + response.json()["access_token"]}
+    return register
+
+@pytest.fixture
+def statements(engine):
+    """SQL statements the app sends while the test runs, as their first keyword"""
+    from sqlalchemy import event
+    sent = []
+    def record(connection, cursor, statement, parameters, context, executemany):
+        sent.append(statement.split(None, 1)[0].upper())
+    event.listen(engine, "before_cursor_execute", record)
+    yield sent
+    event.remove(engine, "before_cursor_execute", record)
@@ -0,0 +1,36 @@
+"""/login and /resend read the Auth row once, see crud.get_login"""
+import datetime
+
+QUERIES = {"SELECT", "INSERT", "UPDATE", "DELETE"}
+
+def queries(statements: list) -> list:
+    return [statement for statement in statements if statement in QUERIES]
+
+def test_login_selects_once(client, register, statements):
+    register("login@quore.test", "login")
+    statements.clear()
+    response = client.post("/login", json={"email": "login@quore.test", "password": "passw0rd1"})
+    assert response.status_code == 200
+    assert queries(statements) == ["SELECT"]
+
+def test_failed_login_selects_once(client, register, statements):
+    register("failed@quore.test", "failed")
+    statements.clear()
+    response = client.post("/login", json={"email": "failed@quore.test", "password": "wrong"})
+    assert response.status_code == 401
+    assert queries(statements) == ["SELECT"]
+
+def test_resend_selects_and_updates_once(client, register, statements):
+    from app.data import database, models
+    register("resend@quore.test", "resend")
+    with database.session() as db:
+        db.query(models.Auth).filter(models.Auth.email == "resend@quore.test").update({models.Auth.verified: False, models.Auth.sent: datetime.datetime(2000, 1, 1)})
+        db.commit()
+    statements.clear()
+    response = client.get("/resend/resend@quore.test")
+    assert response.json() == {"result": "success"}
+    assert queries(statements) == ["SELECT", "UPDATE"]
+    statements.clear()
+    response = client.get("/resend/resend@quore.test")
+    assert response.status_code == 425
+    assert queries(statements) == ["SELECT"]
@@ -0,0 +1,18 @@
+"""/cards filters stay inside the ranges crud.birth_range can turn into dates"""
+import json
+import pytest
+
+@pytest.mark.parametrize("query", ["agefrom=-1", "agefrom=151", "ageto=100000000"])
+def test_ages_out_of_range_are_rejected(client, register, query):
+    headers = register(f"cards-{query}@quore.test", "cards")
+    assert client.get("/cards?" + query, headers=headers).status_code == 422
+
+def test_ages_out_of_range_in_preferences_are_ignored(client, register):
+    from app.data import database, models
+    headers = register("preferences@quore.test", "preferences")
+    with database.session() as db:
+        db.query(models.Profile).filter(models.Profile.name == "preferences").update(
+            {models.Profile.preferences: json.dumps({"agefrom": "18", "ageto": 10 ** 9})})
+        db.commit()
+    response = client.get("/cards", headers=headers)
+    assert response.status_code == 200
@@ -0,0 +1,114 @@
+"""
+Every statement the hot crud paths send is EXPLAINed against a seeded database large enough for the planner
+to prefer an index wherever one fits. A plan that still reads a whole large table, as a Seq Scan or as an index scan
+without an index condition, is missing an index. The seed and everything the calls write are rolled back.
+The default seed of 20k profiles and 200k likes is already past where the planner switches to the indexes and keeps
+the suite fast. Production-like sizes, such as 100k profiles with 100 likes each, are set with the QUERY_PLAN_* variables
+"""
+from os import environ
+from sqlalchemy import event, text
+from sqlalchemy.orm import Session
+import json, pytest
+
+LARGE_TABLES = {"profiles", "auth", "likes", "dislikes", "messages", "candidates"}
+# Per profile except PROFILES
+PROFILES = int(environ.get("QUERY_PLAN_PROFILES", 20000))
+LIKES = int(environ.get("QUERY_PLAN_LIKES", 10))
+DISLIKES = int(environ.get("QUERY_PLAN_DISLIKES", 3))
+MESSAGES = int(environ.get("QUERY_PLAN_MESSAGES", 5))
+CANDIDATES = int(environ.get("QUERY_PLAN_CANDIDATES", 10))
+
+@pytest.fixture(scope="module")
+def seeded(engine):
+    with engine.connect() as connection:
+        transaction = connection.begin()
+        connection.execute(text("""
+            INSERT INTO profiles (name, birth, sex, fcm_token, avatar, images, uploaded, latitude, longitude)
+            SELECT 'seed' || i, date '1960-01-01' + i % 15000, CASE WHEN i % 2 = 0 THEN 'm' ELSE 'f' END, 'seed-token' || i,
+                   false, '{}', 0, 55 + i % 500 * 0.01, 37 + i % 400 * 0.01
+            FROM generate_series(1, :count) AS i"""), {"count": PROFILES})
+        ids = [id for id, in connection.execute(text("SELECT id FROM profiles WHERE name LIKE 'seed%' ORDER BY id"))]
+        connection.execute(text("""
+            INSERT INTO auth (id, verified, email, hashed, sent, user_id)
+            SELECT gen_random_uuid(), true, name || '@quore.test', 'hashed', now(), id FROM profiles WHERE name LIKE 'seed%'"""))
+        # LIKES likes, DISLIKES dislikes, MESSAGES messages and CANDIDATES pooled candidates of every profile to profiles spread over the seed
+        pairs = """
+            SELECT ids[i] AS initiator, ids[(i * 7 + k * :step) % cardinality(ids) + 1] AS target, k
+            FROM (SELECT CAST(:ids AS integer[]) AS ids) AS seed, generate_series(1, cardinality(ids)) AS i, generate_series(1, :count) AS k"""
+        connection.execute(text(f"INSERT INTO likes (initiator, target, match, created) SELECT initiator, target, target % 10 = 0, now() "
+                                f"FROM ({pairs}) AS pairs WHERE initiator <> target ON CONFLICT DO NOTHING"), {"ids": ids, "step": 1931, "count": LIKES})
+        connection.execute(text(f"INSERT INTO dislikes (initiator, target, created) SELECT initiator, target, now() "
+                                f"FROM ({pairs}) AS pairs WHERE initiator <> target ON CONFLICT DO NOTHING"), {"ids": ids, "step": 3967, "count": DISLIKES})
+        connection.execute(text(f"INSERT INTO messages (sender, recipient, sent, message, attachments) SELECT initiator, target, now(), 'message', '{{}}' "
+                                f"FROM ({pairs}) AS pairs WHERE initiator <> target"), {"ids": ids, "step": 7, "count": MESSAGES})
+        connection.execute(text(f"INSERT INTO candidates (user_id, candidate_id, score, distance) SELECT initiator, target, k, k "
+                                f"FROM ({pairs}) AS pairs WHERE initiator <> target ON CONFLICT DO NOTHING"), {"ids": ids, "step": 4201, "count": CANDIDATES})
+        connection.execute(text("ANALYZE"))
+        yield connection, ids
+        transaction.rollback()
+
+def calls(crud, ids: list, token):
+    user, other = ids[500], ids[501]
+    return {
+        "get_user_by_email": lambda db: crud.get_user_by_email(db, "seed501@quore.test"),
+        "get_login": lambda db: crud.get_login(db, "seed501@quore.test"),
+        "get_auth_profile": lambda db: crud.get_auth_profile(db, user),
+        "get_auth": lambda db: crud.get_auth(db, token),
+        "verify_auth": lambda db: crud.verify_auth(db, token),
+        "get_profile": lambda db: crud.get_profile(db, user),
+        "change_name": lambda db: crud.change_name(db, user, "name"),
+        "clear_fcm_tokens": lambda db: crud.clear_fcm_tokens(db, ["seed-token1", "seed-token2"]),
+        "get_fcm_tokens": lambda db: crud.get_fcm_tokens(db, ids[:3]),
+        "write_message": lambda db: crud.write_message(db, user, other, "message"),
+        "get_messages": lambda db: crud.get_messages(db, user, ids[0]),
+        "stream_messages": lambda db: list(crud.stream_messages(db, user)),
+        "stream_attachments": lambda db: list(crud.stream_attachments(db, user)),
+        "set_cords": lambda db: crud.set_cords(db, user, 60.0, 30.0),
+        "swipe_like": lambda db: crud.swipe(db, user, ids[900], "like"),
+        "swipe_dislike": lambda db: crud.swipe(db, user, ids[901], "dislike"),
+        "swipes": lambda db: crud.swipes(db, user, {ids[902]: "like", ids[903]: "dislike", ids[904]: "like"}),
+        "get_cards": lambda db: crud.get_cards(db, user, 20, 30, "f", 50, 20),
+        "get_cards_without_radius": lambda db: crud.get_cards(db, other, 20, 22, "f", None, 20),
+        "get_likes": lambda db: crud.get_likes(db, user),
+        "mark_likes_seen": lambda db: crud.mark_likes_seen(db, user),
+        "stream_likes": lambda db: list(crud.stream_likes(db, user)),
+        "stream_dislikes": lambda db: list(crud.stream_dislikes(db, user)),
+        "get_purge_job": lambda db: crud.get_purge_job(db, user),
+        "get_export_job": lambda db: crud.get_export_job(db, user),
+        "create_export_job": lambda db: crud.create_export_job(db, user, "seed@quore.test"),
+        "delete_user": lambda db: crud.delete_user(db, ids[600]),
+    }
+
+def full_scans(node: dict) -> list[str]:
+    """Large tables the plan reads in full"""
+    scans = []
+    if node.get("Relation Name") in LARGE_TABLES and (node["Node Type"] == "Seq Scan" or "Index Name" in node and "Index Cond" not in node):
+        scans.append(node["Relation Name"])
+    for child in node.get("Plans", []):
+        scans += full_scans(child)
+    return scans
+
+NAMES = list(calls(None, [0] * PROFILES, None))
+
+@pytest.mark.parametrize("name", NAMES)
+def test_no_sequential_scans(seeded, name):
+    from app.data import crud
+    connection, ids = seeded
+    token = connection.execute(text("SELECT id FROM auth WHERE user_id = :id"), {"id": ids[500]}).scalar()
+    plans = []
+    def explain(connection, cursor, statement, parameters, context, executemany):
+        if executemany or statement.lstrip().upper().startswith(("SAVEPOINT", "RELEASE", "ROLLBACK", "EXPLAIN", "SET")) or "pg_advisory" in statement:
+            return
+        explained = connection.connection.dbapi_connection.cursor()
+        explained.execute("EXPLAIN (FORMAT JSON) " + statement, parameters)
+        plans.append((statement, explained.fetchone()[0][0]["Plan"]))
+    event.listen(connection, "before_cursor_execute", explain)
+    db = Session(bind=connection, join_transaction_mode="create_savepoint")
+    try:
+        calls(crud, ids, token)[name](db)
+    finally:
+        db.close()
+        event.remove(connection, "before_cursor_execute", explain)
+    assert plans
+    for statement, plan in plans:
+        assert not full_scans(plan), f"{statement}\n{json.dumps(plan, indent=2)}"